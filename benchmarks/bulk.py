@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+""" Measures RT index loading throughput of single worker.
+
+Uses testproject settings, so searchd from test_config/sphinx.conf must be
+running. Test index is truncated before each run. Printed numbers include
+searchd indexing time, not only statement building.
+
+    python benchmarks/bulk.py [documents] [batch_size]
+"""
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "testproject"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testproject.settings")
+
+
+def make_objects(model, count):
+    return [model(id=i + 1, sphinx_field='document %d text' % i,
+                  attr_uint=i, attr_string='attribute %d' % i,
+                  attr_multi=[i % 7, i % 11], attr_json={'key': i})
+            for i in range(count)]
+
+
+def truncate(model, using):
+    from django.db import connections
+    with connections[using].cursor() as cursor:
+        cursor.execute("TRUNCATE RTINDEX %s" % model._meta.db_table)
+
+
+def measure(name, func, model, count, using):
+    truncate(model, using)
+    objs = make_objects(model, count)
+    started = time.time()
+    func(objs)
+    elapsed = time.time() - started
+    print("%-20s %10d %12.0f" % (name, count, count / elapsed))
+
+
+def main(documents=100000, batch_size=None):
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from testapp import models
+
+    using = settings.SPHINX_DATABASE_NAME
+    model = models.TestModel
+    objects = model.objects.all()
+
+    def create_each(objs):
+        for obj in objs:
+            obj.save(force_insert=True)
+
+    print("%-20s %10s %12s" % ("method", "documents", "docs/s"))
+    # single-row inserts are too slow for full document set
+    measure('save()', create_each, model, min(documents, 5000), using)
+    measure('bulk_create()',
+            lambda objs: objects.bulk_create(objs, batch_size=batch_size),
+            model, documents, using)
+    measure('bulk_replace()',
+            lambda objs: objects.bulk_replace(objs, batch_size=batch_size),
+            model, documents, using)
+    truncate(model, using)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+""" Measures SphinxQL SELECT compilation time per query.
+
+Compares compiler emitting LIMIT, GROUP <N> BY and WITHIN GROUP ORDER BY
+clauses natively with emulation of previous approach: MySQL-flavoured
+clauses patched with regular expressions after compilation. Statement cache
+is disabled for both, third column shows native compiler with cache.
+
+Uses testproject settings, so searchd from test_config/sphinx.conf must be
+running (server version is requested once while compiling).
+
+    python benchmarks/compiler.py [iterations]
+"""
+import os
+import re
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "testproject"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testproject.settings")
+
+
+def get_querysets(models):
+    objects = models.TestModel.objects
+    return [
+        ('filter + limit', lambda: objects.filter(
+            attr_uint=1, attr_bool=True)[10:20]),
+        ('match + options', lambda: objects.match('hello').options(
+            ranker='bm25', max_matches=1000).order_by('-attr_uint')[:20]),
+        ('group n by', lambda: objects.filter(attr_uint__gte=0).group_by(
+            'attr_uint', group_limit=2, group_order_by='-attr_float')[:20]),
+    ]
+
+
+def get_regex_compiler():
+    from sphinxsearch.backend.sphinx.compiler import SphinxQLCompiler
+
+    class RegexPatchingCompiler(SphinxQLCompiler):
+        """ Emits MySQL LIMIT and GROUP BY clauses and patches them with
+        regular expressions, as compiler did before native clauses."""
+
+        def get_group_by_clause(self, group_by):
+            if not group_by:
+                return '', []
+            return ('GROUP BY %s' % ', '.join(sql for sql, _ in group_by),
+                    [p for _, params in group_by for p in params])
+
+        def get_limits(self):
+            low_mark, high_mark = self.query.low_mark, self.query.high_mark
+            if high_mark is None and not low_mark:
+                return '', []
+            if high_mark is None:
+                limit = self.connection.ops.no_limit_value()
+            else:
+                limit = high_mark - low_mark
+            sql = 'LIMIT %d' % limit
+            if low_mark:
+                sql += ' OFFSET %d' % low_mark
+            return sql, []
+
+        def get_trailing_clauses(self, with_limits=True):
+            # OPTION clause was appended after patching
+            return [c for c in super(RegexPatchingCompiler, self
+                                     ).get_trailing_clauses(with_limits)
+                    if not c[0].startswith('OPTION ')]
+
+        def as_sql(self, *args, **kwargs):
+            sql, params = super(RegexPatchingCompiler, self).as_sql(
+                *args, **kwargs)
+            if not sql:
+                return sql, params
+            # removed patching code
+            sql = re.sub(r'LIMIT (\d+) OFFSET (\d+)$', 'LIMIT \\2, \\1', sql)
+            group_limit = getattr(self.query, 'group_limit', '')
+            if group_limit:
+                group_by = 'GROUP %s BY \\1' % group_limit
+            else:
+                group_by = 'GROUP BY \\1'
+            group_by += self.get_group_ordering()
+            sql = re.sub(r'GROUP BY ((\w+)(, \w+)*)', group_by, sql)
+            options_sql, options_params = self.get_options()
+            if options_sql:
+                sql += ' OPTION %s' % options_sql
+                params = tuple(params) + tuple(options_params)
+            return sql, params
+
+    return RegexPatchingCompiler
+
+
+def measure(factory, iterations, using, compiler_class=None):
+    from django.db import connections
+    query = factory().query
+    connection = connections[using]
+
+    def compile_query():
+        # compiler modifies query, so each iteration compiles a fresh copy
+        if compiler_class is None:
+            query.clone().get_compiler(using).as_sql()
+        else:
+            compiler_class(query.clone(), connection, using).as_sql()
+    return min(timeit.repeat(compile_query, number=iterations, repeat=5))
+
+
+def main(iterations=2000):
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from testapp import models
+    from sphinxsearch.backend.sphinx.cache import statement_cache
+
+    using = settings.SPHINX_DATABASE_NAME
+    regex_compiler = get_regex_compiler()
+    print("%-20s %10s %10s %10s %10s" % (
+        "query", "regex, us", "native, us", "saved, us", "cached, us"))
+    for name, factory in get_querysets(models):
+        statement_cache._max_size = 0
+        regex = measure(factory, iterations, using, regex_compiler)
+        native = measure(factory, iterations, using)
+        statement_cache._max_size = None
+        cached = measure(factory, iterations, using)
+        regex, native, cached = [t / iterations * 10 ** 6
+                                 for t in (regex, native, cached)]
+        print("%-20s %10.1f %10.1f %10.1f %10.1f" % (
+            name, regex, native, regex - native, cached))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -22,6 +22,8 @@ setup(
         'sphinxsearch',
         'sphinxsearch.backend',
         'sphinxsearch.backend.sphinx',
+        'sphinxsearch.management',
+        'sphinxsearch.management.commands',
     ],
     url='http://github.com/rutube/django_sphinxsearch',
     license='Beerware',
@@ -0,0 +1,2 @@
+# coding: utf-8
+from sphinxsearch.buffer import batch_writes
@@ -0,0 +1,120 @@
+# coding: utf-8
+""" Blue/green index aliases.
+
+settings.SPHINX_INDEX_ALIASES maps index name used by models (alias) to
+concrete RT indexes, first one being active by default:
+
+    SPHINX_INDEX_ALIASES = {
+        'articles': ('articles_blue', 'articles_green'),
+    }
+
+Active index name is kept in django cache (settings.SPHINX_ALIAS_CACHE,
+'default' by default) and is re-read by each process every
+settings.SPHINX_ALIAS_REFRESH seconds (1 by default).
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+ACTIVE_KEY = 'sphinxsearch:alias:%s'
+PREVIOUS_KEY = 'sphinxsearch:alias:%s:previous'
+
+# alias -> (active index, expiration time)
+_active = {}
+# indexes forced with using_index() in current thread
+_overrides = threading.local()
+
+
+def get_aliases():
+    return getattr(settings, 'SPHINX_INDEX_ALIASES', None) or {}
+
+
+def get_indexes(alias):
+    """ Returns concrete indexes for alias."""
+    try:
+        return tuple(get_aliases()[alias])
+    except KeyError:
+        raise ValueError("Unknown index alias %s" % alias)
+
+
+def _get_cache():
+    from django.core.cache import caches
+    return caches[getattr(settings, 'SPHINX_ALIAS_CACHE', 'default')]
+
+
+def get_active(alias, refresh=False):
+    """ Returns concrete index used by readers of alias."""
+    indexes = get_indexes(alias)
+    now = time.time()
+    cached = _active.get(alias)
+    if cached is None or refresh or cached[1] < now:
+        index = _get_cache().get(ACTIVE_KEY % alias)
+        if index not in indexes:
+            index = indexes[0]
+        ttl = getattr(settings, 'SPHINX_ALIAS_REFRESH', 1.0)
+        cached = _active[alias] = (index, now + ttl)
+    return cached[0]
+
+
+def get_shadow(alias):
+    """ Returns concrete index not used by readers of alias."""
+    active = get_active(alias, refresh=True)
+    return [index for index in get_indexes(alias) if index != active][0]
+
+
+def swap(alias, index=None):
+    """ Switches readers of alias to another concrete index.
+
+    :param index: new active index, shadow index by default
+    :returns: previously active index
+    :rtype: str
+    """
+    previous = get_active(alias, refresh=True)
+    if index is None:
+        index = get_shadow(alias)
+    elif index not in get_indexes(alias):
+        raise ValueError("%s is not an index of alias %s" % (index, alias))
+    cache = _get_cache()
+    cache.set(PREVIOUS_KEY % alias, previous, None)
+    cache.set(ACTIVE_KEY % alias, index, None)
+    _active.pop(alias, None)
+    return previous
+
+
+def rollback(alias):
+    """ Switches readers of alias back to index active before last swap.
+
+    :returns: previously active index
+    :rtype: str
+    """
+    previous = _get_cache().get(PREVIOUS_KEY % alias)
+    if previous is None:
+        raise ValueError("Alias %s was not swapped" % alias)
+    return swap(alias, previous)
+
+
+@contextmanager
+def using_index(alias, index):
+    """ Resolves alias to index in current thread, i.e. for loading shadow
+    index while readers use active one."""
+    if index not in get_indexes(alias):
+        raise ValueError("%s is not an index of alias %s" % (index, alias))
+    overrides = _overrides.__dict__
+    previous = overrides.get(alias)
+    overrides[alias] = index
+    try:
+        yield
+    finally:
+        if previous is None:
+            del overrides[alias]
+        else:
+            overrides[alias] = previous
+
+
+def resolve(name):
+    """ Returns concrete index for alias or name itself."""
+    if name not in get_aliases():
+        return name
+    return _overrides.__dict__.get(name) or get_active(name)
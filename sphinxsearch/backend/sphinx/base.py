@@ -2,8 +2,17 @@
 
 from django.db.backends.mysql import base, creation
 from django.db.backends.mysql.base import server_version_re
+from MySQLdb.constants import CLIENT
 from django.utils.functional import cached_property
 
+from sphinxsearch import aliases
+from sphinxsearch.utils import statement_size
+
+# searchd max_packet_size default value
+DEFAULT_MAX_PACKET_SIZE = 8 * 1024 * 1024
+# bytes reserved for statement prefix and protocol overhead
+PACKET_SIZE_RESERVE = 4096
+
 
 class SphinxOperations(base.DatabaseOperations):
 
@@ -12,6 +21,10 @@ class SphinxOperations(base.DatabaseOperations):
 
     compiler_module = "sphinxsearch.backend.sphinx.compiler"
 
+    def quote_name(self, name):
+        """ Resolves blue/green index aliases to concrete index names."""
+        return super(SphinxOperations, self).quote_name(aliases.resolve(name))
+
     def fulltext_search_sql(self, field_name):
         """ Formats full-text search expression."""
         return 'MATCH (\'@%s "%%s"\')' % field_name
@@ -67,6 +80,50 @@ class SphinxFeatures(base.DatabaseFeatures):
     is_sql_auto_is_null_enabled = False
 
 
+class StatementPipeline(object):
+    """ Collects statements not returning rows and sends them to searchd as
+    multi-statement requests fitting max_packet_size.
+
+    Pending statements are sent on exit from context manager.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.limit = connection.max_statement_size
+        self.pending = []
+        self.size = 0
+        self.requests = 0
+
+    def add(self, sql, params, size=None):
+        """ Adds statement to pipeline, sending pending ones if request size
+        limit is reached.
+
+        :param size: statement size estimated with statement_size()
+        """
+        if size is None:
+            size = statement_size(sql, params)
+        if self.pending and self.size + size > self.limit:
+            self.flush()
+        self.pending.append((sql, params))
+        self.size += size
+
+    def flush(self):
+        """ Sends pending statements."""
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending, self.size = [], 0
+        self.connection.execute_multi(pending)
+        self.requests += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+
 class DatabaseWrapper(base.DatabaseWrapper):
     def __init__(self, *args, **kwargs):
         super(DatabaseWrapper, self).__init__(*args, **kwargs)
@@ -78,6 +135,69 @@ class DatabaseWrapper(base.DatabaseWrapper):
     def _start_transaction_under_autocommit(self):
         raise NotImplementedError()
 
+    def get_connection_params(self):
+        """ Enables multi-statement requests used by execute_multi(), which
+        MySQLdb doesn't allow by default."""
+        kwargs = super(DatabaseWrapper, self).get_connection_params()
+        kwargs['client_flag'] = (kwargs.get('client_flag', 0) |
+                                 CLIENT.MULTI_STATEMENTS |
+                                 CLIENT.MULTI_RESULTS)
+        return kwargs
+
+    def execute_multi(self, statements):
+        """ Executes several statements in one round trip to searchd.
+
+        :param statements: list of (sql, params) tuples
+        :returns: list of fetched rows for each statement
+        :rtype: list
+        """
+        if not statements:
+            return []
+        sql = '; '.join(s for s, _ in statements)
+        params = tuple(p for _, ps in statements for p in ps)
+        with self.cursor() as cursor:
+            cursor.execute(sql, params)
+            results = [list(cursor.fetchall())]
+            while cursor.nextset():
+                results.append(list(cursor.fetchall()))
+        return results
+
+    @cached_property
+    def max_packet_size(self):
+        """ Max request size accepted by searchd.
+
+        Set with MAX_PACKET_SIZE key of database settings, should match
+        max_packet_size in searchd configuration (8M by default).
+        """
+        return self.settings_dict.get('MAX_PACKET_SIZE',
+                                      DEFAULT_MAX_PACKET_SIZE)
+
+    @property
+    def max_statement_size(self):
+        """ Max size of statements sent in one request."""
+        return self.max_packet_size - PACKET_SIZE_RESERVE
+
+    def pipeline(self):
+        """ Returns pipeline sending statements several per round trip.
+
+        >>> with connection.pipeline() as pipeline:
+        ...     pipeline.add(sql, params)
+        """
+        return StatementPipeline(self)
+
+    def execute_pipelined(self, statements):
+        """ Executes statements not returning rows, sending as many of them
+        in one round trip as max_packet_size allows.
+
+        :param statements: iterable of (sql, params) tuples
+        :returns: number of round trips made
+        :rtype: int
+        """
+        with self.pipeline() as pipeline:
+            for sql, params in statements:
+                pipeline.add(sql, params)
+        return pipeline.requests
+
     @cached_property
     def mysql_version(self):
         # Django>=1.10 makes if differently
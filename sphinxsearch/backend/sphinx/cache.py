@@ -0,0 +1,78 @@
+# coding: utf-8
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+
+class StatementCache(object):
+    """ Bounded LRU cache of compiled SphinxQL statement templates.
+
+    Keys are normalized query shapes built by SphinxQLCompiler, values are
+    opaque compiled statements. Cache size is taken from
+    settings.SPHINX_STATEMENT_CACHE_SIZE (256 by default), zero size disables
+    caching.
+    """
+
+    default_size = 256
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'SPHINX_STATEMENT_CACHE_SIZE',
+                       self.default_size)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """ Returns cached statement for key or None, updating counters."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move to the end of LRU queue
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        max_size = self.max_size
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ Returns hit/miss counters and current cache size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'max_size': self.max_size,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+statement_cache = StatementCache()
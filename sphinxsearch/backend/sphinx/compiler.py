@@ -1,16 +1,19 @@
 # coding: utf-8
 from collections import OrderedDict
-import re
 from django.core.exceptions import FieldError
 from django.db import models
-from django.db.models.expressions import Random
+from django.db.models.expressions import Random, RawSQL
 from django.db.models.lookups import Search, Exact
 from django.db.models.sql import compiler, AND
-from django.db.models.sql.constants import ORDER_DIR
+from django.db.models.sql.constants import ORDER_DIR, MULTI, SINGLE
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.sql.query import get_order_dir
+from django.db.utils import DatabaseError
 
 from django.utils import six
-from sphinxsearch import sql as sqls
+from sphinxsearch import (aliases, refresh, result_cache, singleflight,
+                          sql as sqls)
+from sphinxsearch.backend.sphinx.cache import statement_cache
 from sphinxsearch.utils import sphinx_escape
 
 
@@ -19,6 +22,9 @@ class SphinxQLCompiler(compiler.SQLCompiler):
     # there.
     safe_options = ('ranker', 'field_weights', 'index_weights')
 
+    # IN() is a function in sphinxsearch SELECT statements
+    in_template = '(IN(%s, %s))'
+
     def compile(self, node, select_format=False):
         sql, params = super(SphinxQLCompiler, self).compile(node, select_format)
 
@@ -30,6 +36,130 @@ class SphinxQLCompiler(compiler.SQLCompiler):
 
         return sql, params
 
+    def execute_sql(self, result_type=MULTI, *args, **kwargs):
+        """ Executes query, fetching FACET results and SHOW META in same round
+        trip if needed.
+
+        Returns rows fetched by multi-statement query if present.
+        """
+        query = self.query
+        rows = getattr(query, 'fetched_rows', None)
+        facets = getattr(query, 'facets', None)
+        if rows is not None:
+            # query is already executed, only setup selected columns
+            self.as_sql()
+        elif result_type == MULTI and getattr(query, 'result_cache', None):
+            rows = self.execute_cached()
+        elif result_type == MULTI and (facets or
+                                       getattr(query, 'with_meta', False) or
+                                       self.can_share_results()):
+            rows = self.execute_with_extras()
+        elif facets:
+            # count(), exists() and other single-row queries don't need
+            # FACET result sets
+            query.facets = None
+            try:
+                return super(SphinxQLCompiler, self).execute_sql(
+                    result_type, *args, **kwargs)
+            finally:
+                query.facets = facets
+        else:
+            return super(SphinxQLCompiler, self).execute_sql(
+                result_type, *args, **kwargs)
+        rows = [row[:self.col_count] for row in rows]
+        if result_type == SINGLE:
+            return rows[0] if rows else None
+        if result_type == MULTI:
+            return iter([rows])
+        return None
+
+    def execute_with_extras(self):
+        """ Executes SELECT with FACET clauses and SHOW META in one round trip.
+
+        FACET and SHOW META results are stored to query.fetched_facets and
+        query.fetched_meta.
+
+        :returns: fetched rows
+        :rtype: list
+        """
+        statements = self.get_multi_statements()
+        results = None
+        if statements:
+            results = iter(self.fetch_results(statements))
+        return self.query.set_fetched_results(results)
+
+    def execute_cached(self):
+        """ Executes query using cached results if possible.
+
+        Result sets of all statements (FACET, SHOW META) are cached together
+        with key containing compiled statements and write generation of
+        index.
+
+        :returns: fetched rows
+        :rtype: list
+        """
+        ttl, alias = self.query.result_cache
+        statements = self.get_multi_statements()
+        if not statements:
+            return self.query.set_fetched_results(None)
+        index = aliases.resolve(self.query.model._meta.db_table)
+        key = result_cache.make_key(index, self.using, statements)
+        cache = result_cache.get_cache(alias)
+        cached = result_cache.get_results(cache, key)
+        result_cache.result_cache_stats.add(cached is not None)
+        if cached is None:
+            results = self.fetch_results(statements)
+            expires = result_cache.set_results(cache, key, results, ttl)
+        else:
+            expires, results = cached
+        refresher = refresh.get_refresher()
+        if refresher is not None:
+            refresher.track(index, self.using, alias, ttl, statements,
+                            expires)
+        return self.query.set_fetched_results(iter(results))
+
+    def can_share_results(self):
+        """ Checks if results may be shared with concurrent threads executing
+        same query: singleflight is enabled and query doesn't see
+        uncommitted writes of searchd transaction."""
+        return (singleflight.get_timeout() is not None and
+                not self.connection.in_atomic_block)
+
+    def fetch_results(self, statements):
+        """ Executes statements in one round trip, waiting for results of
+        same statements executed by another thread if possible.
+
+        :returns: list of fetched rows for each statement
+        :rtype: list
+        """
+        def execute():
+            return self.connection.execute_multi(statements)
+
+        if not self.can_share_results():
+            return execute()
+        index = aliases.resolve(self.query.model._meta.db_table)
+        key = (index, self.using, repr(statements))
+        return singleflight.flights.do(key, execute,
+                                       singleflight.get_timeout())
+
+    def get_multi_statements(self):
+        """ Returns list of (sql, params) statements executed for query.
+
+        SELECT statement is followed by SHOW META if requested; FACET clauses
+        produce extra result sets for SELECT statement itself. Empty list is
+        returned if query has empty result.
+        """
+        try:
+            sql, params = self.as_sql()
+        except EmptyResultSet:
+            return []
+        if not sql:
+            return []
+        statements = [(sql, params)]
+        if getattr(self.query, 'with_meta', False):
+            statements.append((sqls.SphinxMeta.statement, ()))
+        return statements
+
     def get_order_by(self):
         res = super(SphinxQLCompiler, self).get_order_by()
 
@@ -43,16 +173,34 @@ class SphinxQLCompiler(compiler.SQLCompiler):
         return order_by
 
     def get_group_by(self, select, order_by):
-        res = super(SphinxQLCompiler, self).get_group_by(select, order_by)
+        """ Returns GROUP BY expressions set by SphinxQuerySet.group_by().
 
-        # override GROUP BY columns for sphinxsearch's "GROUP N BY" support
-        group_by = getattr(self.query, 'group_by', None)
-        if group_by:
-            fields = self.query.model._meta.fields
-            field_columns = [f.column for f in fields if f.attname in group_by]
-            return [r for r in res if r[0] in field_columns]
+        Unlike Django, sphinxsearch doesn't require all selected columns to be
+        in GROUP BY clause, so only requested columns and expressions are
+        returned. Selected annotations are grouped by alias, because
+        sphinxsearch can't group by expression.
+        """
+        group_by = self.query.group_by
+        if group_by is None or group_by is True:
+            return super(SphinxQLCompiler, self).get_group_by(select, order_by)
 
-        return res
+        aliases = {id(expr): alias for alias, expr
+                   in self.query.annotation_select.items()}
+        result = []
+        for expr in group_by:
+            if id(expr) in aliases:
+                sql = self.connection.ops.quote_name(aliases[id(expr)])
+                params = []
+            elif isinstance(expr, RawSQL):
+                # select alias, expression or JSON attribute path
+                sql, params = expr.sql, list(expr.params)
+            else:
+                if not hasattr(expr, 'as_sql'):
+                    expr = self.query.resolve_ref(expr)
+                sql, params = self.compile(expr)
+            if (sql, params) not in result:
+                result.append((sql, params))
+        return result
 
     @staticmethod
     def _quote(s, negative=True):
@@ -95,12 +243,35 @@ class SphinxQLCompiler(compiler.SQLCompiler):
         return result.strip(' ')
 
     def as_sql(self, with_limits=True, with_col_aliases=False, subquery=False):
-        """ Patching final SQL query."""
-        where, self.query.where = self.query.where, sqls.SphinxWhereNode()
+        """ Creates SphinxQL SELECT query.
+
+        WHERE conditions are temporarily moved to SELECT clause, query state is
+        restored after compilation, so same query could be compiled again.
+        """
+        query = self.query
+        where = query.where
+        where_result = query.annotations.get('__where_result')
+        annotation_mask = query.annotation_select_mask
+        try:
+            return self.compile_sphinxql(where, with_limits, with_col_aliases,
+                                         subquery)
+        finally:
+            query.where = where
+            if where_result is None:
+                query.annotations.pop('__where_result', None)
+            else:
+                query.annotations['__where_result'] = where_result
+            query.set_annotation_mask(annotation_mask)
+
+    def compile_sphinxql(self, where, with_limits=True, with_col_aliases=False,
+                         subquery=False):
+        """ Creates SphinxQL SELECT query, using statement cache if possible."""
+        self.query.where = sqls.SphinxWhereNode()
         match = getattr(self.query, 'match', None)
+        match_expr = None
         if match:
             # add match extra where
-            self._add_match_extra(match)
+            match_expr = self._add_match_extra(match)
 
         connection = self.connection
 
@@ -120,44 +291,290 @@ class SphinxQLCompiler(compiler.SQLCompiler):
                 None, None,
                 ['__where_result = %s'], (True,), None, None)
 
-        sql, args = super(SphinxQLCompiler, self).as_sql(with_limits,
-                                                         with_col_aliases)
+        if with_limits and self.query.low_mark == self.query.high_mark:
+            return '', ()
 
-        # empty SQL doesn't need patching
-        if (sql, args) == ('', ()):
-            return sql, args
+        # query shape is known now, so repeated queries only bind parameters
+        # to SQL template compiled before.
+        statement_key = self.get_statement_key(
+            where_sql, with_limits, with_col_aliases, subquery)
+        if statement_key is not None:
+            statement = statement_cache.get(statement_key)
+            if statement is not None:
+                return self.bind_statement(statement, where_params,
+                                           match_expr, with_limits)
+
+        sql, args = self.compile_select(with_limits, with_col_aliases,
+                                        subquery)
+
+        if statement_key is not None:
+            statement = self.make_statement(sql, args, where_params,
+                                            match_expr, with_limits)
+            if statement is not None:
+                statement_cache.set(statement_key, statement)
+        return sql, args
 
-        # removing unsupported by sphinxsearch OFFSET clause
-        # replacing it with LIMIT <offset>, <limit>
-        sql = re.sub(r'LIMIT (\d+) OFFSET (\d+)$', 'LIMIT \\2, \\1', sql)
+    def compile_select(self, with_limits=True, with_col_aliases=False,
+                       subquery=False):
+        """ Creates SphinxQL SELECT statement.
 
-        # patching GROUP BY clause
-        group_limit = getattr(self.query, 'group_limit', '')
-        group_by_ordering = self.get_group_ordering()
+        It's a copy of compiler.SQLCompiler.as_sql method that emits sphinxsearch
+        GROUP <N> BY, WITHIN GROUP ORDER BY, LIMIT <offset>, <limit> and OPTION
+        clauses.
+        """
+        self.subquery = subquery
+        refcounts_before = self.query.alias_refcount.copy()
+        try:
+            extra_select, order_by, group_by = self.pre_sql_setup()
+            combinator = getattr(self.query, 'combinator', None)
+            if combinator:
+                raise DatabaseError(
+                    '%s is not supported by sphinxsearch' % combinator)
+            distinct_fields = self.get_distinct()
+
+            # This must come after 'select', 'ordering', and 'distinct' -- see
+            # docstring of get_from_clause() for details.
+            from_, f_params = self.get_from_clause()
+            (where, w_params), (having, h_params) = self.compile_where_having()
+
+            result = ['SELECT']
+            params = []
+
+            if self.query.distinct:
+                result.append(
+                    self.connection.ops.distinct_sql(distinct_fields))
+
+            out_cols = []
+            col_idx = 1
+            for _, (s_sql, s_params), alias in self.select + extra_select:
+                if alias:
+                    s_sql = '%s AS %s' % (
+                        s_sql, self.connection.ops.quote_name(alias))
+                elif with_col_aliases:
+                    s_sql = '%s AS %s' % (s_sql, 'Col%d' % col_idx)
+                    col_idx += 1
+                params.extend(s_params)
+                out_cols.append(s_sql)
+
+            result.append(', '.join(out_cols))
+
+            result.append('FROM')
+            result.extend(from_)
+            params.extend(f_params)
+
+            if where:
+                result.append('WHERE %s' % where)
+                params.extend(w_params)
+
+            group_sql, group_params = self.get_group_by_clause(group_by)
+            if group_sql:
+                result.append(group_sql)
+                params.extend(group_params)
+
+            if having:
+                result.append('HAVING %s' % having)
+                params.extend(h_params)
+
+            if order_by:
+                ordering = []
+                for _, (o_sql, o_params, _) in order_by:
+                    ordering.append(o_sql)
+                    params.extend(o_params)
+                result.append('ORDER BY %s' % ', '.join(ordering))
+
+            for clause_sql, clause_params in self.get_trailing_clauses(
+                    with_limits):
+                result.append(clause_sql)
+                params.extend(clause_params)
+
+            return ' '.join(result), tuple(params)
+        finally:
+            # Finally do cleanup - get rid of the joins we created above.
+            self.query.reset_refcounts(refcounts_before)
+
+    def compile_where_having(self):
+        """ Returns compiled WHERE and HAVING clauses."""
+        if hasattr(self, 'having'):
+            # Django>=1.9 splits query.where in pre_sql_setup()
+            where, having = self.where, self.having
+        else:
+            where, having = self.query.where, self.query.having
+        return [self.compile(node) if node is not None else ('', [])
+                for node in (where, having)]
+
+    def get_group_by_clause(self, group_by):
+        """ Formats GROUP [<N>] BY clause with WITHIN GROUP ORDER BY."""
+        if not group_by:
+            return '', []
+        grouping = []
+        params = []
+        for g_sql, g_params in group_by:
+            grouping.append(g_sql)
+            params.extend(g_params)
+        group_limit = getattr(self.query, 'group_limit', None)
         if group_limit:
-            # add GROUP <N> BY expression
-            group_by = 'GROUP %s BY \\1' % group_limit
+            sql = 'GROUP %d BY %s' % (group_limit, ', '.join(grouping))
         else:
-            group_by = 'GROUP BY \\1'
-        if group_by_ordering:
-            # add WITHIN GROUP ORDER BY expression
-            group_by += group_by_ordering
-        sql = re.sub(r'GROUP BY ((\w+)(, \w+)*)', group_by, sql)
-
-        # adding sphinxsearch OPTION clause
+            sql = 'GROUP BY %s' % ', '.join(grouping)
+        return sql + self.get_group_ordering(), params
+
+    def get_limits(self):
+        """ Formats LIMIT <offset>, <limit> clause."""
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        if high_mark is not None:
+            limit = high_mark - low_mark
+        elif low_mark:
+            limit = self.connection.ops.no_limit_value()
+        else:
+            return '', []
+        if low_mark:
+            return 'LIMIT %s, %s', [low_mark, limit]
+        return 'LIMIT %s', [limit]
+
+    def get_trailing_clauses(self, with_limits=True):
+        """ Returns list of clauses following ORDER BY as (sql, params)."""
+        clauses = []
+        if with_limits:
+            limit_sql, limit_params = self.get_limits()
+            if limit_sql:
+                clauses.append((limit_sql, limit_params))
+        options_sql, options_params = self.get_options()
+        if options_sql:
+            clauses.append(('OPTION %s' % options_sql, options_params))
+        for _, facet_sql in getattr(self.query, 'facets', None) or ():
+            clauses.append((facet_sql, []))
+        return clauses
+
+    def get_trailing_params(self, with_limits=True):
+        """ Returns parameters for clauses following ORDER BY."""
+        return [p for _, params in self.get_trailing_clauses(with_limits)
+                for p in params]
+
+    def get_options(self):
+        """ Returns OPTION clause contents and it's parameters."""
         options = getattr(self.query, 'options', None)
-        if options:
-            keys = sorted(options.keys())
-            values = [options[k] for k in keys if k not in self.safe_options]
-
-            opts = []
-            for k in keys:
-                if k in self.safe_options:
-                    opts.append("%s=%s" % (k, options[k]))
-                else:
-                    opts.append("%s=%%s" % k)
-            sql += ' OPTION %s' % ', '.join(opts) or ''
-            args += tuple(values)
+        if not options:
+            return '', ()
+        keys = sorted(options.keys())
+        values = [options[k] for k in keys if k not in self.safe_options]
+
+        opts = []
+        for k in keys:
+            if k in self.safe_options:
+                opts.append("%s=%s" % (k, options[k]))
+            else:
+                opts.append("%s=%%s" % k)
+        return ', '.join(opts), values
+
+    def get_extra_select_params(self):
+        """ Returns parameters of query.extra(select=...) columns."""
+        return [p for _, params in self.query.extra_select.values()
+                for p in params]
+
+    def get_statement_key(self, where_sql, *args):
+        """ Returns normalized query shape used as statement cache key.
+
+        Values passed as query parameters (filter values, LIMIT and OPTION
+        values, MATCH expression text) are not the part of the key, so queries
+        differing only with these values share compiled SQL template.
+
+        :returns: hashable key or None if query can't be cached.
+        """
+        if not statement_cache.enabled:
+            return None
+        query = self.query
+        if (getattr(query, 'combinator', None) or query.select_for_update or
+                getattr(query, 'having', None)):
+            return None
+        options = getattr(query, 'options', None) or {}
+        match = getattr(query, 'match', None) or {}
+        try:
+            return (
+                type(self), self.using, query.model,
+                aliases.resolve(query.model._meta.db_table), where_sql, args,
+                tuple((a, s) for a, (s, _) in query.extra_select.items()),
+                tuple((a, repr(e)) for a, e in query.annotation_select.items()
+                      if a != '__where_result'),
+                tuple(map(repr, query.select)), query.default_cols,
+                tuple(getattr(query, 'values_select', ())),
+                tuple(sorted(query.deferred_loading[0])),
+                query.deferred_loading[1],
+                repr(query.select_related), tuple(query.extra_tables),
+                query.distinct, tuple(query.distinct_fields),
+                tuple(map(repr, query.order_by)),
+                tuple(map(repr, query.extra_order_by)),
+                query.default_ordering, query.standard_ordering,
+                repr(query.group_by),
+                getattr(query, 'group_limit', None),
+                tuple(getattr(query, 'group_order_by', None) or ()),
+                bool(query.low_mark), query.high_mark is None,
+                tuple((k, options[k] if k in self.safe_options else None)
+                      for k in sorted(options.keys())),
+                tuple(match.keys()),
+                tuple(getattr(query, 'facets', None) or ()),
+            )
+        except TypeError:
+            # unhashable value found somewhere in query state
+            return None
+
+    def make_statement(self, sql, args, where_params, match_expr,
+                       with_limits=True):
+        """ Prepares compiled SQL for statement cache.
+
+        Query parameters are split to value-dependent parts (extra select
+        params, WHERE params, LIMIT and OPTION values) and constant parts,
+        determined by query shape.
+        """
+        if match_expr is not None:
+            if sql.count(match_expr) != 1:
+                return None
+            sql_parts = tuple(sql.split(match_expr))
+        else:
+            sql_parts = (sql,)
+
+        args = list(args)
+        extra_params = self.get_extra_select_params()
+        trailing_params = self.get_trailing_params(with_limits)
+        where_params = list(where_params)
+
+        # position of __where_result parameters in SELECT clause
+        where_pos = 0
+        for _, (s_sql, s_params), alias in self.select:
+            if alias == '__where_result':
+                break
+            where_pos += len(s_params)
+        where_end = where_pos + len(where_params)
+        trailing_pos = len(args) - len(trailing_params)
+
+        if (args[:len(extra_params)] != extra_params or
+                args[where_pos:where_end] != where_params or
+                args[trailing_pos:] != trailing_params or
+                not len(extra_params) <= where_pos <= where_end <= trailing_pos):
+            # unexpected parameters layout, don't cache statement
+            return None
+
+        return {
+            'sql_parts': sql_parts,
+            'head_params': tuple(args[len(extra_params):where_pos]),
+            'tail_params': tuple(args[where_end:trailing_pos]),
+            'state': (self.select, self.klass_info, self.annotation_col_map,
+                      self.col_count),
+        }
+
+    def bind_statement(self, statement, where_params, match_expr,
+                       with_limits=True):
+        """ Binds current query parameters to cached statement."""
+        (self.select, self.klass_info, self.annotation_col_map,
+         self.col_count) = statement['state']
+        if match_expr is not None:
+            sql = match_expr.join(statement['sql_parts'])
+        else:
+            sql = statement['sql_parts'][0]
+        args = (tuple(self.get_extra_select_params()) +
+                statement['head_params'] +
+                tuple(where_params) +
+                statement['tail_params'] +
+                tuple(self.get_trailing_params(with_limits)))
         return sql, args
 
     def get_group_ordering(self):
@@ -210,29 +627,45 @@ class SphinxQLCompiler(compiler.SQLCompiler):
 
         # add MATCH() to query.where
         self.query.where.add(sqls.SphinxExtraWhere([match_expr], []), AND)
+        return match_expr
 
 
 # Set SQLCompiler appropriately, so queries will use the correct compiler.
 SQLCompiler = SphinxQLCompiler
 
 
-class SQLInsertCompiler(compiler.SQLInsertCompiler, SphinxQLCompiler):
-    pass
+class SphinxWriteCompilerMixin(object):
+    """ Invalidates cached search results of index after write."""
 
+    def execute_sql(self, *args, **kwargs):
+        try:
+            return super(SphinxWriteCompilerMixin, self).execute_sql(
+                *args, **kwargs)
+        finally:
+            result_cache.bump_generation(
+                aliases.resolve(self.query.model._meta.db_table))
 
-class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SphinxQLCompiler):
-    def as_sql(self):
-        sql, params = super(SQLDeleteCompiler, self).as_sql()
 
-        # empty SQL doesn't need patching
-        if (sql, params) == ('', ()):
-            return sql, params
+class SQLInsertCompiler(SphinxWriteCompilerMixin, compiler.SQLInsertCompiler,
+                        SphinxQLCompiler):
 
-        sql = re.sub(r'\(IN\((\w+),\s([\w\s\%,]+)\)\)', '\\1 IN (\\2)', sql)
-        return sql, params
+    def as_sql(self, *args, **kwargs):
+        result = super(SQLInsertCompiler, self).as_sql(*args, **kwargs)
+        if getattr(self.query, 'replace', False):
+            # REPLACE INTO has same syntax as INSERT INTO
+            result = [('REPLACE' + sql[len('INSERT'):], params)
+                      for sql, params in result]
+        return result
+
+
+class SQLDeleteCompiler(SphinxWriteCompilerMixin, compiler.SQLDeleteCompiler,
+                        SphinxQLCompiler):
+    # sphinxsearch DELETE supports only "id IN (...)" syntax
+    in_template = '%s IN (%s)'
 
 
-class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SphinxQLCompiler):
+class SQLUpdateCompiler(SphinxWriteCompilerMixin, compiler.SQLUpdateCompiler,
+                        SphinxQLCompiler):
 
     # noinspection PyMethodOverriding
     def as_sql(self):
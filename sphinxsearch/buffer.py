@@ -0,0 +1,316 @@
+# coding: utf-8
+""" Write-behind buffer for SphinxModel.save() and delete() calls."""
+import atexit
+import copy
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('sphinxsearch.buffer')
+
+# pending write operations
+REPLACE = 'replace'
+DELETE = 'delete'
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+# batches started with batch_writes() in current thread
+_batches = threading.local()
+
+
+class PendingWrites(object):
+    """ Document writes coalesced per (model, pk).
+
+    Only last saved state of document is kept, saves followed by delete are
+    dropped.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self._pending = OrderedDict()
+
+    def replace(self, obj):
+        """ Adds document state to pending writes.
+
+        :raises ValueError: document has deferred fields, which would be
+            erased by REPLACE
+        """
+        deferred = obj.get_deferred_fields()
+        if deferred:
+            raise ValueError("Can't replace %s with deferred fields: %s" % (
+                type(obj).__name__, ', '.join(sorted(deferred))))
+        # proxy models share pending writes with concrete document model
+        key = (obj._meta.concrete_model, obj.pk)
+        self._add(key, REPLACE, copy.deepcopy(obj))
+
+    def delete(self, model, pk):
+        """ Adds document deletion to pending writes."""
+        self._add((model, pk), DELETE, None)
+
+    def _add(self, key, op, obj):
+        self._pending.pop(key, None)
+        self._pending[key] = (op, obj)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush_document(self, model, pk):
+        """ Writes pending operation of document, if any, before it is written
+        directly."""
+        key = (model, pk)
+        if key in self._pending:
+            self._write(OrderedDict([(key, self._pending.pop(key))]))
+
+    def _write(self, pending, batch_size=None, transaction=False):
+        """ Writes pending operations with multi-row statements.
+
+        :param transaction: wrap writes to each index in RT transaction
+        """
+        from django.db import connections, transaction as db_transaction
+        from sphinxsearch.models import SphinxQuerySet
+        # searchd allows only one RT index per transaction
+        indexes = OrderedDict()
+        for (model, pk), (op, obj) in pending.items():
+            replaced, deleted = indexes.setdefault(model, ([], []))
+            if op == REPLACE:
+                replaced.append(obj)
+            else:
+                deleted.append(pk)
+        for model, (replaced, deleted) in indexes.items():
+            qs = SphinxQuerySet(model, using=self.using)
+            if not transaction:
+                self._write_index(qs, replaced, deleted, batch_size)
+                continue
+            with db_transaction.atomic(using=self.using, savepoint=False):
+                with connections[self.using].cursor() as cursor:
+                    cursor.execute('BEGIN')
+                self._write_index(qs, replaced, deleted, batch_size)
+
+    @staticmethod
+    def _write_index(qs, replaced, deleted, batch_size):
+        if deleted:
+            qs.bulk_delete(ids=deleted, batch_size=batch_size or 1000)
+        if replaced:
+            qs.bulk_replace(replaced, batch_size=batch_size)
+
+
+class WriteBuffer(PendingWrites):
+    """ Coalescing write-behind buffer for one sphinx database.
+
+    Background thread flushes pending writes with multi-row REPLACE and
+    DELETE statements when max_size writes are pending or every
+    flush_interval seconds. Writers block while max_pending writes are
+    waiting for flush.
+
+    Signals are not sent for buffered writes. Failed flushes are logged and
+    their writes are put back to buffer, unless same documents were written
+    again meanwhile, to be retried with next flush. Writes failed
+    max_attempts times or not fitting max_pending are logged and dropped.
+    """
+
+    def __init__(self, using, max_size=1000, flush_interval=1.0,
+                 max_pending=10000, max_attempts=3):
+        super(WriteBuffer, self).__init__(using)
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, max_size)
+        self.max_attempts = max_attempts
+        # number of failed flushes by document
+        self._attempts = {}
+        self._cond = threading.Condition()
+        self._flushing = threading.Lock()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='sphinxsearch-write-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, flush=True):
+        """ Stops background thread, flushing pending writes."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+
+    def _add(self, key, op, obj):
+        with self._cond:
+            # backpressure: wait until pending writes are flushed
+            while (key not in self._pending and not self._stopped and
+                   len(self._pending) >= self.max_pending):
+                self._cond.wait()
+            super(WriteBuffer, self)._add(key, op, obj)
+            self._attempts.pop(key, None)
+            if len(self._pending) >= self.max_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """ Writes all pending documents.
+
+        :returns: number of written operations
+        :rtype: int
+        """
+        with self._flushing:
+            with self._cond:
+                pending, self._pending = self._pending, OrderedDict()
+                self._cond.notify_all()
+            if not pending:
+                return 0
+            try:
+                self._write(pending, batch_size=self.max_size)
+            except Exception:
+                self._requeue(pending)
+                raise
+            with self._cond:
+                for key in pending:
+                    self._attempts.pop(key, None)
+            return len(pending)
+
+    def _requeue(self, pending):
+        """ Puts failed writes back before ones added during flush, dropping
+        ones failed max_attempts times or exceeding max_pending."""
+        dropped = 0
+        with self._cond:
+            requeued = OrderedDict()
+            room = self.max_pending - len(self._pending)
+            for key, op in pending.items():
+                if key in self._pending:
+                    # document is written again
+                    continue
+                attempts = self._attempts.pop(key, 0) + 1
+                if attempts >= self.max_attempts or len(requeued) >= room:
+                    dropped += 1
+                    continue
+                self._attempts[key] = attempts
+                requeued[key] = op
+            requeued.update(self._pending)
+            self._pending = requeued
+        if dropped:
+            logger.error("Dropped %d sphinxsearch writes after failed flush",
+                         dropped)
+
+    def flush_document(self, model, pk):
+        with self._flushing:
+            with self._cond:
+                op = self._pending.pop((model, pk), None)
+                self._attempts.pop((model, pk), None)
+                self._cond.notify_all()
+            if op is not None:
+                self._write(OrderedDict([((model, pk), op)]))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.flush_interval
+                while (not self._stopped and
+                       len(self._pending) < self.max_size):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    break
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush sphinxsearch write buffer")
+        # background thread has its own database connection
+        from django.db import connections
+        connections[self.using].close()
+
+
+class WriteBatch(PendingWrites):
+    """ Writes collected by batch_writes() block."""
+
+    def __init__(self, using, batch_size=None):
+        super(WriteBatch, self).__init__(using)
+        self.batch_size = batch_size
+
+    def commit(self):
+        """ Writes pending documents with one RT transaction per index."""
+        pending, self._pending = self._pending, OrderedDict()
+        self._write(pending, batch_size=self.batch_size, transaction=True)
+
+
+@contextmanager
+def batch_writes(using, batch_size=None):
+    """ Collects SphinxModel.save() and delete() calls in current thread and
+    writes them on exit with multi-row statements.
+
+    Writes to each index are wrapped in RT transaction, block touching
+    several indexes is committed with several transactions. Writes are
+    discarded if block raises an exception; nested blocks join outer one.
+
+    Documents with deferred fields (i.e. loaded from index) and saves with
+    update_fields are not batched, but written immediately after pending
+    write of same document.
+
+    >>> with batch_writes('sphinx'):
+    ...     for obj in objs:
+    ...         obj.save()
+
+    :param batch_size: max number of documents written by one statement
+    """
+    batches = _batches.__dict__
+    if using in batches:
+        yield batches[using]
+        return
+    batch = batches[using] = WriteBatch(using, batch_size=batch_size)
+    try:
+        yield batch
+    finally:
+        del batches[using]
+    batch.commit()
+
+
+def enable_write_buffer(using, **kwargs):
+    """ Starts write buffer for database, buffering SphinxModel.save() and
+    delete() calls in current process.
+
+    Keyword arguments are passed to WriteBuffer. Pending writes are flushed
+    at interpreter exit.
+
+    :returns: started write buffer
+    :rtype: WriteBuffer
+    """
+    with _buffers_lock:
+        if using in _buffers:
+            return _buffers[using]
+        write_buffer = _buffers[using] = WriteBuffer(using, **kwargs)
+        write_buffer.start()
+    return write_buffer
+
+
+def disable_write_buffer(using):
+    """ Stops write buffer for database, flushing pending writes."""
+    with _buffers_lock:
+        write_buffer = _buffers.pop(using, None)
+    if write_buffer is not None:
+        write_buffer.stop()
+
+
+def get_write_buffer(using):
+    """ Returns batch_writes() block or write buffer active for database in
+    current thread, or None."""
+    batch = _batches.__dict__.get(using)
+    if batch is not None:
+        return batch
+    return _buffers.get(using)
+
+
+@atexit.register
+def _flush_on_exit():
+    for using in list(_buffers):
+        try:
+            disable_write_buffer(using)
+        except Exception:
+            logger.exception("Failed to flush sphinxsearch write buffer")
@@ -0,0 +1,255 @@
+# coding: utf-8
+""" Consistency checks of RT index against source database."""
+import math
+
+from django.db import connections, router
+from django.db.models import (Count, Sum, Min, Max, F, Func, Value,
+                              IntegerField, CharField, TextField, FloatField)
+
+from sphinxsearch.fields import SphinxDateTimeField
+from sphinxsearch.models import SphinxQuerySet
+
+# values and ids are reduced by modulus before multiplying, so that sums of
+# products don't overflow 64-bit integers of sphinxsearch
+HASH_MODULUS = 65521
+# float attributes are 32-bit in index and are compared with this precision
+FLOAT_SCALE = 1000
+
+
+class IntDiv(Func):
+    """ Integer division of non-negative expression."""
+    arg_joiner = ' / '
+    template = '(%(expressions)s)'
+
+    def as_mysql(self, compiler, connection):
+        clone = self.copy()
+        clone.arg_joiner = ' DIV '
+        return clone.as_sql(compiler, connection)
+
+    def as_oracle(self, compiler, connection):
+        clone = self.copy()
+        clone.template = 'FLOOR(%(expressions)s)'
+        return clone.as_sql(compiler, connection)
+
+
+class Mod(Func):
+    """ Remainder of integer division."""
+    arg_joiner = ' %% '
+    template = '(%(expressions)s)'
+
+    def as_mysql(self, compiler, connection):
+        clone = self.copy()
+        clone.arg_joiner = ' MOD '
+        return clone.as_sql(compiler, connection)
+
+    def as_oracle(self, compiler, connection):
+        clone = self.copy()
+        clone.arg_joiner = ', '
+        clone.template = 'MOD(%(expressions)s)'
+        return clone.as_sql(compiler, connection)
+
+
+class CRC32(Func):
+    """ CRC32 checksum of string, available in MySQL and sphinxsearch."""
+    function = 'CRC32'
+
+
+class Floor(Func):
+    """ Largest integer not greater than expression."""
+    function = 'FLOOR'
+
+
+class IndexChecker(object):
+    """ Finds documents differing from source objects of SphinxIndexer.
+
+    Primary key space is split to ranges, digest of each range (number of
+    rows, sum of ids and sum of row hashes for each of check_fields) is
+    computed on both sides with one grouped query per level. Only ranges
+    with different digests are split further; ranges of leaf_size ids are
+    compared row by row.
+
+    Row hash is product of field value and document id, both reduced by
+    HASH_MODULUS, so values swapped between documents change the digest.
+    String values are hashed with CRC32() (source database must support it,
+    i.e. MySQL), float values are rounded to 1 / FLOAT_SCALE. Full-text
+    fields are not stored in index and are not compared.
+
+    :param indexer: SphinxIndexer instance
+    :param check_fields: names of integer, float or string attributes with
+        same values in source objects and documents, compared in addition
+        to ids
+    :param parts: number of subranges for each differing range
+    :param leaf_size: max size of range compared row by row
+    """
+
+    def __init__(self, indexer, check_fields=(), parts=1000, leaf_size=1000):
+        self.indexer = indexer
+        self.check_fields = tuple(check_fields)
+        self.parts = parts
+        self.leaf_size = leaf_size
+        self.queries = 0
+
+    @property
+    def index(self):
+        return self.indexer.index
+
+    def get_source_queryset(self):
+        """ Returns source objects expected to be indexed."""
+        return self.indexer.get_check_queryset()
+
+    def get_bounds(self):
+        """ Returns (start, stop) range covering both source and index ids."""
+        source = self.get_source_queryset().aggregate(
+            min=Min('pk'), max=Max('pk'))
+        index = self.index.objects.all().aggregate(
+            min=Min('pk'), max=Max('pk'))
+        self.queries += 2
+        mins = [b['min'] for b in (source, index) if b['min'] is not None]
+        maxs = [b['max'] for b in (source, index) if b['max'] is not None]
+        if not mins:
+            return None
+        return min(mins), max(maxs) + 1
+
+    def get_field_kind(self, name):
+        """ Returns 'string', 'float' or 'integer' for index field name."""
+        field = self.index._meta.get_field(name)
+        if isinstance(field, (CharField, TextField)):
+            return 'string'
+        if (isinstance(field, FloatField) and
+                not isinstance(field, SphinxDateTimeField)):
+            return 'float'
+        return 'integer'
+
+    def row_hash(self, name):
+        """ Returns expression of row hash for check field name."""
+        kind = self.get_field_kind(name)
+        value = F(name)
+        if kind == 'string':
+            value = CRC32(value, output_field=IntegerField())
+        elif kind == 'float':
+            value = Floor(value * Value(FLOAT_SCALE) + Value(0.5),
+                          output_field=IntegerField())
+        return (Mod(value, HASH_MODULUS, output_field=IntegerField()) *
+                Mod(F('pk'), HASH_MODULUS, output_field=IntegerField()))
+
+    def row_hash_sql(self, name):
+        """ Returns SphinxQL expression of row hash for check field name."""
+        kind = self.get_field_kind(name)
+        value = self.index._meta.get_field(name).column
+        if kind == 'string':
+            value = 'CRC32(%s)' % value
+        elif kind == 'float':
+            value = 'FLOOR(%s * %d + 0.5)' % (value, FLOAT_SCALE)
+        return '(%s MOD %d) * (id MOD %d)' % (value, HASH_MODULUS,
+                                              HASH_MODULUS)
+
+    def normalize(self, name, value):
+        """ Returns field value as it is compared row by row."""
+        if value is not None and self.get_field_kind(name) == 'float':
+            return int(math.floor(value * FLOAT_SCALE + 0.5))
+        return value
+
+    @staticmethod
+    def split(start, stop, parts):
+        """ Splits range to at most parts ranges of equal size."""
+        step = max(1, -(-(stop - start) // parts))
+        return step, [(lo, min(lo + step, stop))
+                      for lo in range(start, stop, step)]
+
+    def source_digests(self, start, stop, step):
+        """ Returns digests of source subranges by their start, computed with
+        one grouped query."""
+        keys = ['count', 'ids']
+        aggregates = {'count': Count('*'), 'ids': Sum('pk')}
+        for name in self.check_fields:
+            keys.append('hash_' + name)
+            aggregates['hash_' + name] = Sum(self.row_hash(name))
+        part = IntDiv(F('pk') - start, step, output_field=IntegerField())
+        rows = self.get_source_queryset().filter(
+            pk__gte=start, pk__lt=stop).annotate(part=part).order_by(
+        ).values('part').annotate(**aggregates)
+        parts = -(-(stop - start) // step)
+        if isinstance(rows, SphinxQuerySet):
+            # source model is another index
+            rows = rows.options(max_matches=max(parts, 1000))
+        rows = rows[:parts]
+        self.queries += 1
+        return {start + row['part'] * step: tuple(int(row[k] or 0)
+                                                  for k in keys)
+                for row in rows}
+
+    def index_digests(self, start, stop, step):
+        """ Returns digests of index subranges by their start, computed with
+        one grouped query."""
+        using = router.db_for_read(self.index)
+        connection = connections[using]
+        meta = self.index._meta
+        columns = ''.join(', SUM(%s)' % self.row_hash_sql(name)
+                          for name in self.check_fields)
+        parts = -(-(stop - start) // step)
+        sql = ("SELECT IDIV(id - %d, %d) AS part, COUNT(*), SUM(id)%s "
+               "FROM %s WHERE id >= %d AND id < %d GROUP BY part "
+               "LIMIT %d OPTION max_matches=%d" % (
+                   start, step, columns, connection.ops.quote_name(
+                       meta.db_table), start, stop, parts, max(parts, 1000)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        self.queries += 1
+        return {start + row[0] * step: tuple(int(v or 0) for v in row[1:])
+                for row in rows}
+
+    def compare_rows(self, start, stop):
+        """ Returns ids of differing documents in range."""
+        fields = ('pk',) + self.check_fields
+        source = self.get_source_queryset().filter(
+            pk__gte=start, pk__lt=stop).order_by().values_list(*fields)
+        index = self.index.objects.filter(
+            pk__gte=start, pk__lt=stop).values_list(*fields)
+        limit = stop - start
+        index = index.options(max_matches=max(limit, 1000))[:limit]
+        source = dict((row[0], self.normalize_row(row)) for row in source)
+        index = dict((row[0], self.normalize_row(row)) for row in index)
+        self.queries += 2
+        return sorted(pk for pk in set(source) | set(index)
+                      if source.get(pk) != index.get(pk))
+
+    def normalize_row(self, row):
+        """ Returns (pk, *check_fields) row with normalized values."""
+        return row[:1] + tuple(self.normalize(name, value) for name, value
+                               in zip(self.check_fields, row[1:]))
+
+    def find_differences(self, start=None, stop=None):
+        """ Yields lists of ids of documents differing from source objects.
+
+        :param start: first checked id, lowest source or index id by default
+        :param stop: id next to last checked one
+        """
+        if start is None or stop is None:
+            bounds = self.get_bounds()
+            if bounds is None:
+                return
+            start = bounds[0] if start is None else start
+            stop = bounds[1] if stop is None else stop
+        ranges = [(start, stop)]
+        while ranges:
+            start, stop = ranges.pop()
+            if stop - start <= self.leaf_size:
+                ids = self.compare_rows(start, stop)
+                if ids:
+                    yield ids
+                continue
+            step, parts = self.split(start, stop, self.parts)
+            source = self.source_digests(start, stop, step)
+            index = self.index_digests(start, stop, step)
+            # depth-first with ascending ranges
+            ranges.extend(reversed([(lo, hi) for lo, hi in parts
+                                    if source.get(lo) != index.get(lo)]))
+
+    def repair(self, ids):
+        """ Rebuilds documents for ids, removing ones missing in source.
+
+        :returns: number of written documents
+        :rtype: int
+        """
+        return self.indexer.update(ids)
@@ -3,4 +3,27 @@
 
 import django
 
+DJ_19 = django.VERSION >= (1, 9, 0)
+DJ_10 = django.VERSION >= (1, 10, 0)
 DJ_11 = django.VERSION >= (1, 11, 0)
+
+
+def prefetch_related_objects(objs, *lookups):
+    """ Prefetches related objects for list of model instances."""
+    if DJ_10:
+        from django.db.models import prefetch_related_objects as prefetch
+        prefetch(objs, *lookups)
+    else:
+        from django.db.models.query import prefetch_related_objects as prefetch
+        prefetch(objs, lookups)
+
+
+def on_commit(func, using=None):
+    """ Calls func after current transaction is committed, immediately when
+    called in autocommit mode."""
+    if DJ_19:
+        from django.db import transaction
+        transaction.on_commit(func, using=using)
+    else:
+        # transaction hooks are not available in Django-1.8
+        func()
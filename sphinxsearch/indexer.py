@@ -0,0 +1,341 @@
+# coding: utf-8
+""" Mirroring of relational models to sphinx RT indexes."""
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.signals import request_started, request_finished
+from django.db import router
+from django.db.models import Min, Max, Q
+from django.db.models.signals import post_save, post_delete
+
+from sphinxsearch import compat
+
+logger = logging.getLogger('sphinxsearch.indexer')
+
+# pending index operations
+INDEX = 'index'
+DELETE = 'delete'
+
+
+class SphinxIndexer(object):
+    """ Mirrors rows of source model to SphinxModel index.
+
+    Saved and deleted source objects are queued by post_save and
+    post_delete signals. Documents are built for batches of queued
+    primary keys, fetching source objects with one query per batch;
+    select_related and prefetch_related remove per-document queries for
+    related objects.
+
+    >>> class ArticleIndexer(SphinxIndexer):
+    ...     model = Article
+    ...     index = ArticleIndex
+    ...     fields = ('title', 'created')
+    ...     select_related = ('author',)
+    ...
+    ...     def get_document(self, obj):
+    ...         values = super(ArticleIndexer, self).get_document(obj)
+    ...         values['author_name'] = obj.author.name
+    ...         return values
+    >>> ArticleIndexer().connect()
+
+    Queue is flushed at end of request, when batch_size changes are queued
+    and on exit from batch() block; outside of them changes are written
+    immediately. Flushes are postponed until commit of source database
+    transaction (Django>=1.9), so rolled back changes are not indexed.
+    """
+    # source django model
+    model = None
+    # SphinxModel subclass for index
+    index = None
+    # names of fields copied from source objects to documents
+    fields = ()
+    select_related = ()
+    prefetch_related = ()
+    batch_size = 1000
+    # source field with row modification time, used by index_updated()
+    updated_field = None
+    # model recording ids of deleted source rows, used by delete_tombstones()
+    tombstone_model = None
+    tombstone_field = 'object_id'
+    tombstone_time_field = 'deleted_at'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def _pending(self):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = OrderedDict()
+        return pending
+
+    @property
+    def _batching(self):
+        return getattr(self._local, 'batching', 0)
+
+    def get_queryset(self):
+        """ Returns source objects queryset for building documents."""
+        qs = self.model._default_manager.all()
+        if self.select_related:
+            qs = qs.select_related(*self.select_related)
+        if self.prefetch_related:
+            qs = qs.prefetch_related(*self.prefetch_related)
+        return qs
+
+    def get_check_queryset(self):
+        """ Returns source objects expected to be in index, used by
+        consistency checks; should match should_index() filtering."""
+        return self.get_queryset()
+
+    def should_index(self, obj):
+        """ Returns False for source objects excluded from index."""
+        return True
+
+    def get_document(self, obj):
+        """ Returns dict of document field values for source object.
+
+        :raises ValueError: some of fields are deferred in source object,
+            i.e. it is a SphinxModel without full-text field values
+        """
+        deferred = obj.get_deferred_fields().intersection(self.fields)
+        if deferred:
+            raise ValueError("%s fields are deferred in %s: %s" % (
+                type(self).__name__, type(obj).__name__,
+                ', '.join(sorted(deferred))))
+        return {name: getattr(obj, name) for name in self.fields}
+
+    def build_documents(self, objs):
+        """ Returns index documents for source objects."""
+        docs = []
+        for obj in objs:
+            values = self.get_document(obj)
+            values.setdefault(self.index._meta.pk.attname, obj.pk)
+            docs.append(self.index(**values))
+        return docs
+
+    def update(self, pks):
+        """ Rebuilds documents for source objects with primary keys.
+
+        Documents are removed for objects missing in source or excluded from
+        index.
+
+        :returns: number of written documents
+        :rtype: int
+        """
+        pks = list(pks)
+        written = 0
+        for i in range(0, len(pks), self.batch_size):
+            chunk = pks[i:i + self.batch_size]
+            objs = [obj for obj in self.get_queryset().filter(pk__in=chunk)
+                    if self.should_index(obj)]
+            docs = self.build_documents(objs)
+            indexed = set(obj.pk for obj in objs)
+            self.delete([pk for pk in chunk if pk not in indexed])
+            if docs:
+                self.index.objects.bulk_replace(docs)
+            written += len(docs)
+        return written
+
+    def get_ranges(self, range_size):
+        """ Splits primary key space of source objects to ranges.
+
+        :returns: list of (start, stop) tuples for start <= pk < stop
+        :rtype: list
+        """
+        bounds = self.get_queryset().aggregate(min=Min('pk'), max=Max('pk'))
+        if bounds['min'] is None:
+            return []
+        stop = bounds['max'] + 1
+        return [(start, min(start + range_size, stop))
+                for start in range(bounds['min'], stop, range_size)]
+
+    def iter_source(self, start, stop):
+        """ Streams source objects with start <= pk < stop by batches.
+
+        Objects are fetched with QuerySet.iterator() (server-side cursor
+        where database supports it), related objects are prefetched for each
+        batch.
+        """
+        qs = self.get_queryset().filter(pk__gte=start, pk__lt=stop)
+        chunk = []
+        for obj in qs.order_by('pk').iterator():
+            chunk.append(obj)
+            if len(chunk) >= self.batch_size:
+                yield self._prefetch(chunk)
+                chunk = []
+        if chunk:
+            yield self._prefetch(chunk)
+
+    def _prefetch(self, objs):
+        if self.prefetch_related:
+            compat.prefetch_related_objects(objs, *self.prefetch_related)
+        return objs
+
+    def index_range(self, start, stop):
+        """ Writes documents for source objects with start <= pk < stop.
+
+        :returns: number of written documents
+        :rtype: int
+        """
+        written = 0
+        for chunk in self.iter_source(start, stop):
+            docs = self.build_documents(
+                [obj for obj in chunk if self.should_index(obj)])
+            if docs:
+                self.index.objects.bulk_replace(docs)
+            written += len(docs)
+        return written
+
+    def index_updated(self, since=None):
+        """ Writes documents for source objects modified after watermark.
+
+        Objects are selected with "updated_field >= since" condition by
+        chunks ordered by updated_field and primary key, so cost depends on
+        number of changes when updated_field is indexed in source database.
+        Objects modified at watermark time are written again, because rows
+        with same updated_field value may be committed after previous run.
+
+        :returns: number of written documents and new watermark value
+        :rtype: tuple
+        """
+        field = self.updated_field
+        if field is None:
+            raise ValueError("%s.updated_field is not set" %
+                             type(self).__name__)
+        qs = self.get_queryset().filter(**{field + '__isnull': False})
+        if since is not None:
+            qs = qs.filter(**{field + '__gte': since})
+        qs = qs.order_by(field, 'pk')
+        written = 0
+        last = None
+        while True:
+            chunk_qs = qs
+            if last is not None:
+                updated = getattr(last, field)
+                chunk_qs = qs.filter(Q(**{field + '__gt': updated}) |
+                                     Q(**{field: updated, 'pk__gt': last.pk}))
+            chunk = list(chunk_qs[:self.batch_size])
+            if not chunk:
+                break
+            self._prefetch(chunk)
+            objs = [obj for obj in chunk if self.should_index(obj)]
+            indexed = set(obj.pk for obj in objs)
+            self.delete([obj.pk for obj in chunk if obj.pk not in indexed])
+            docs = self.build_documents(objs)
+            if docs:
+                self.index.objects.bulk_replace(docs)
+            written += len(docs)
+            last = chunk[-1]
+            since = getattr(last, field)
+        return written, since
+
+    def delete_tombstones(self, since=None):
+        """ Removes documents for source rows recorded in tombstone_model
+        after watermark.
+
+        :returns: number of processed tombstones and new watermark value
+        :rtype: tuple
+        """
+        if self.tombstone_model is None:
+            return 0, since
+        time_field = self.tombstone_time_field
+        qs = self.tombstone_model._default_manager.all()
+        if since is not None:
+            qs = qs.filter(**{time_field + '__gt': since})
+        rows = qs.order_by(time_field).values_list(self.tombstone_field,
+                                                    time_field)
+        pks = []
+        processed = 0
+        for pk, deleted_at in rows.iterator():
+            pks.append(pk)
+            processed += 1
+            since = deleted_at
+            if len(pks) >= self.batch_size:
+                self.delete(pks)
+                pks = []
+        self.delete(pks)
+        return processed, since
+
+    def delete(self, pks):
+        """ Removes documents for source primary keys."""
+        if pks:
+            self.index.objects.all().bulk_delete(ids=pks,
+                                                 batch_size=self.batch_size)
+
+    def flush(self):
+        """ Writes queued changes of current thread."""
+        pending, self._local.pending = self._pending, OrderedDict()
+        self.delete([pk for pk, op in pending.items() if op == DELETE])
+        self.update([pk for pk, op in pending.items() if op == INDEX])
+
+    @contextmanager
+    def batch(self):
+        """ Queues changes made in block, writing them on exit."""
+        self._local.batching = self._batching + 1
+        try:
+            yield self
+        finally:
+            self._local.batching -= 1
+        if not self._batching:
+            compat.on_commit(self.flush,
+                             using=router.db_for_write(self.model))
+
+    def _queue(self, pk, op, using):
+        pending = self._pending
+        pending.pop(pk, None)
+        pending[pk] = op
+        if not self._batching or len(pending) >= self.batch_size:
+            # changes queued before rollback are flushed later, documents of
+            # missing source rows are removed
+            compat.on_commit(self.flush, using=using)
+
+    def _post_save(self, sender, instance, raw=False, using=None, **kwargs):
+        if not raw:
+            self._queue(instance.pk, INDEX, using)
+
+    def _post_delete(self, sender, instance, using=None, **kwargs):
+        self._queue(instance.pk, DELETE, using)
+
+    def _request_started(self, **kwargs):
+        self._local.batching = self._batching + 1
+
+    def _request_finished(self, **kwargs):
+        if self._batching:
+            self._local.batching -= 1
+        if not self._batching:
+            try:
+                self.flush()
+            except Exception:
+                # don't break response with indexing errors
+                logger.exception("Failed to flush %s queue" %
+                                 type(self).__name__)
+
+    def _dispatch_uid(self, signal):
+        return '%s.%s:%s' % (type(self).__module__, type(self).__name__,
+                             signal)
+
+    def connect(self):
+        """ Starts mirroring source model changes to index."""
+        post_save.connect(self._post_save, sender=self.model, weak=False,
+                          dispatch_uid=self._dispatch_uid('post_save'))
+        post_delete.connect(self._post_delete, sender=self.model, weak=False,
+                            dispatch_uid=self._dispatch_uid('post_delete'))
+        request_started.connect(
+            self._request_started, weak=False,
+            dispatch_uid=self._dispatch_uid('request_started'))
+        request_finished.connect(
+            self._request_finished, weak=False,
+            dispatch_uid=self._dispatch_uid('request_finished'))
+
+    def disconnect(self):
+        """ Stops mirroring source model changes."""
+        post_save.disconnect(sender=self.model,
+                             dispatch_uid=self._dispatch_uid('post_save'))
+        post_delete.disconnect(sender=self.model,
+                               dispatch_uid=self._dispatch_uid('post_delete'))
+        request_started.disconnect(
+            dispatch_uid=self._dispatch_uid('request_started'))
+        request_finished.disconnect(
+            dispatch_uid=self._dispatch_uid('request_finished'))
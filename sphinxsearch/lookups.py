@@ -11,7 +11,9 @@ class SphinxIn(In):
         lhs, lhs_params = self.process_lhs(compiler, connection)
         rhs, rhs_params = self.batch_process_rhs(compiler, connection)
         rhs_sql = ', '.join(['%s' for _ in range(len(rhs_params))])
-        return '(IN(%s, %s))' % (lhs, rhs_sql), rhs_params
+        # IN syntax differs for SELECT and DELETE statements
+        template = getattr(compiler, 'in_template', '(IN(%s, %s))')
+        return template % (lhs, rhs_sql), rhs_params
 
 
 sphinx_lookups['in'] = SphinxIn
@@ -0,0 +1,48 @@
+# coding: utf-8
+import time
+
+from django.core.management.base import BaseCommand
+
+from sphinxsearch.checker import IndexChecker
+from sphinxsearch.management.commands.sphinx_reindex import load_indexer
+
+
+class Command(BaseCommand):
+    help = ("Finds RT index documents differing from source database with "
+            "id range digests, optionally rebuilding them. Digests are "
+            "sums of ids and of check field values hashed with ids; "
+            "full-text fields are not compared.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('indexer',
+                            help="Dotted path to SphinxIndexer subclass")
+        parser.add_argument('--check-fields', default='',
+                            help="Comma-separated integer, float or "
+                                 "string fields compared in addition to "
+                                 "ids")
+        parser.add_argument('--parts', type=int, default=1000,
+                            help="Number of subranges of differing range")
+        parser.add_argument('--leaf-size', type=int, default=1000,
+                            help="Max size of range compared row by row")
+        parser.add_argument('--repair', action='store_true', default=False,
+                            help="Rebuild differing documents")
+
+    def handle(self, *args, **options):
+        indexer = load_indexer(options['indexer'])
+        check_fields = [f for f in options['check_fields'].split(',') if f]
+        checker = IndexChecker(indexer, check_fields=check_fields,
+                               parts=options['parts'],
+                               leaf_size=options['leaf_size'])
+        started = time.time()
+        found = repaired = 0
+        for ids in checker.find_differences():
+            found += len(ids)
+            self.stdout.write("%d differing documents in %d-%d" %
+                              (len(ids), ids[0], ids[-1]))
+            if options['repair']:
+                repaired += checker.repair(ids)
+        self.stdout.write("Found %d differing documents with %d queries "
+                          "in %.1f s" % (found, checker.queries,
+                                         time.time() - started))
+        if options['repair']:
+            self.stdout.write("Rebuilt %d documents" % repaired)
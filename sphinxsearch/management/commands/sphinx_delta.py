@@ -0,0 +1,72 @@
+# coding: utf-8
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+
+from sphinxsearch.management.commands.sphinx_reindex import load_indexer
+
+
+def load_watermark(value):
+    """ Restores watermark value saved to JSON state file."""
+    if isinstance(value, six.string_types):
+        return parse_datetime(value) or value
+    return value
+
+
+class Command(BaseCommand):
+    help = ("Reindexes source rows modified since last run and removes "
+            "documents for deleted rows recorded as tombstones.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('indexer',
+                            help="Dotted path to SphinxIndexer subclass")
+        parser.add_argument('state_file',
+                            help="File keeping index watermarks")
+        parser.add_argument('--overlap', type=float, default=60,
+                            help="Seconds subtracted from datetime "
+                                 "watermarks to catch late commits "
+                                 "(default: 60)")
+
+    def handle(self, *args, **options):
+        path = options['indexer']
+        indexer = load_indexer(path)
+        state_file = options['state_file']
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get('indexer') != path:
+                raise CommandError("State file %s was written for %s" %
+                                   (state_file, state.get('indexer')))
+        overlap = timedelta(seconds=options['overlap'])
+
+        def since(key):
+            value = load_watermark(state.get(key))
+            if isinstance(value, datetime):
+                value -= overlap
+            return value
+
+        started = time.time()
+        updated_since = since('updated')
+        written, updated = indexer.index_updated(updated_since)
+        deleted, deleted_at = indexer.delete_tombstones(since('deleted'))
+        # overlap is not accumulated when nothing changed
+        state = {
+            'indexer': path,
+            'updated': (state.get('updated') if updated == updated_since
+                        else updated),
+            'deleted': deleted_at if deleted else state.get('deleted'),
+        }
+        tmp = state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, cls=DjangoJSONEncoder)
+        os.rename(tmp, state_file)
+        self.stdout.write("Indexed %d documents, removed %d tombstones "
+                          "in %.1f s" % (written, deleted,
+                                         time.time() - started))
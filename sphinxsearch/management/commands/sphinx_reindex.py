@@ -0,0 +1,170 @@
+# coding: utf-8
+import json
+import os
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.utils.module_loading import import_string
+
+from sphinxsearch import aliases, result_cache
+
+
+def load_indexer(path):
+    """ Returns SphinxIndexer instance for dotted path to its class."""
+    try:
+        return import_string(path)()
+    except ImportError as e:
+        raise CommandError("Can't import indexer %s: %s" % (path, e))
+
+
+@contextmanager
+def target_index(indexer, index=None):
+    """ Directs writes of indexer to concrete index of its alias."""
+    if index is None:
+        yield
+        return
+    with aliases.using_index(indexer.index._meta.db_table, index):
+        yield
+
+
+def _index_range(args):
+    """ Pool worker: writes documents for primary key range."""
+    path, batch_size, index, start, stop = args
+    indexer = load_indexer(path)
+    if batch_size:
+        indexer.batch_size = batch_size
+    with target_index(indexer, index):
+        return start, stop, indexer.index_range(start, stop)
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds RT index from source database, splitting source "
+            "primary keys to ranges indexed in parallel.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('indexer',
+                            help="Dotted path to SphinxIndexer subclass")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of worker processes, each one "
+                                 "using own source and searchd connections")
+        parser.add_argument('--range-size', type=int, default=100000,
+                            help="Number of primary keys in range")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Number of documents built and written "
+                                 "at once")
+        parser.add_argument('--state-file', default=None,
+                            help="File recording finished ranges")
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help="Skip ranges recorded in state file")
+        parser.add_argument('--truncate', action='store_true', default=False,
+                            help="Truncate RT index before indexing")
+        parser.add_argument('--shadow', action='store_true', default=False,
+                            help="Load shadow index of blue/green alias, "
+                                 "truncating it before indexing")
+        parser.add_argument('--swap', action='store_true', default=False,
+                            help="Switch readers to shadow index after "
+                                 "successful indexing")
+
+    def handle(self, *args, **options):
+        path = options['indexer']
+        indexer = load_indexer(path)
+        range_size = options['range_size']
+        state_file = options['state_file']
+        if options['resume'] and not state_file:
+            raise CommandError("--resume requires --state-file")
+        if options['resume'] and options['truncate']:
+            raise CommandError("--resume can't be used with --truncate")
+        if options['swap'] and not options['shadow']:
+            raise CommandError("--swap requires --shadow")
+
+        index = None
+        if options['shadow']:
+            alias = indexer.index._meta.db_table
+            try:
+                index = aliases.get_shadow(alias)
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write("Loading %s shadow index %s" % (alias, index))
+
+        done = []
+        if options['resume'] and os.path.exists(state_file):
+            done = self.load_state(state_file, path, range_size)
+        if options['truncate'] or (index and not options['resume']):
+            with target_index(indexer, index):
+                self.truncate(indexer.index)
+
+        finished = set(tuple(r) for r in done)
+        ranges = [r for r in indexer.get_ranges(range_size)
+                  if r not in finished]
+        self.stdout.write("%d ranges to index, %d finished before" %
+                          (len(ranges), len(finished)))
+
+        tasks = [(path, options['batch_size'], index, start, stop)
+                 for start, stop in ranges]
+        workers = options['workers']
+        if workers > 1:
+            # forked workers must not share parent connections
+            connections.close_all()
+            pool = Pool(workers)
+            results = pool.imap_unordered(_index_range, tasks)
+        else:
+            pool = None
+            results = (_index_range(task) for task in tasks)
+
+        started = time.time()
+        total = 0
+        try:
+            for i, (start, stop, written) in enumerate(results, 1):
+                total += written
+                done.append([start, stop])
+                if state_file:
+                    self.save_state(state_file, path, range_size, done)
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write(
+                    "[%d/%d] %d-%d: %d documents, %.0f docs/s" %
+                    (i, len(tasks), start, stop, written, total / elapsed))
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stdout.write("Indexed %d documents in %.1f s, %.0f docs/s" %
+                          (total, elapsed, total / elapsed))
+        if options['swap']:
+            previous = aliases.swap(indexer.index._meta.db_table, index)
+            self.stdout.write("Switched readers from %s to %s" %
+                              (previous, index))
+
+    @staticmethod
+    def truncate(index):
+        connection = connections[router.db_for_write(index)]
+        with connection.cursor() as cursor:
+            table = aliases.resolve(index._meta.db_table)
+            cursor.execute("TRUNCATE RTINDEX %s" % table)
+        result_cache.bump_generation(table)
+
+    @staticmethod
+    def load_state(state_file, path, range_size):
+        with open(state_file) as f:
+            state = json.load(f)
+        if state['indexer'] != path or state['range_size'] != range_size:
+            raise CommandError("State file %s was written for %s with "
+                               "range size %d" % (state_file, state['indexer'],
+                                                  state['range_size']))
+        return state['done']
+
+    @staticmethod
+    def save_state(state_file, path, range_size, done):
+        tmp = state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'indexer': path, 'range_size': range_size,
+                       'done': done}, f)
+        os.rename(tmp, state_file)
@@ -0,0 +1,43 @@
+# coding: utf-8
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from sphinxsearch import aliases
+
+
+class Command(BaseCommand):
+    help = "Switches readers of blue/green index alias to another index."
+
+    def add_arguments(self, parser):
+        parser.add_argument('alias', help="Index alias")
+        parser.add_argument('--to', dest='index', default=None,
+                            help="New active index, shadow one by default")
+        parser.add_argument('--rollback', action='store_true', default=False,
+                            help="Switch back to index active before last "
+                                 "swap")
+        parser.add_argument('--force', action='store_true', default=False,
+                            help="Allow switching to empty index")
+
+    def handle(self, *args, **options):
+        alias = options['alias']
+        try:
+            if options['rollback']:
+                previous = aliases.rollback(alias)
+            else:
+                index = options['index'] or aliases.get_shadow(alias)
+                if not options['force'] and not self.count(index):
+                    raise CommandError("Index %s is empty, use --force to "
+                                       "switch to it" % index)
+                previous = aliases.swap(alias, index)
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write("Switched %s readers from %s to %s" % (
+            alias, previous, aliases.get_active(alias, refresh=True)))
+
+    @staticmethod
+    def count(index):
+        using = getattr(settings, 'SPHINX_DATABASE_NAME', 'sphinx')
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s" % index)
+            return cursor.fetchone()[0]
@@ -0,0 +1,376 @@
+# coding: utf-8
+""" Django cache backend in memory-mapped file shared by processes of host.
+
+Used for search results cache, so pre-forked workers reuse results fetched
+by any of them without network round trip:
+
+    CACHES = {
+        'sphinx': {
+            'BACKEND': 'sphinxsearch.mmap_cache.MmapCache',
+            'LOCATION': '/dev/shm/sphinxsearch-results',
+            'OPTIONS': {'SIZE': 64 * 1024 * 1024, 'SLOT_SIZE': 16384},
+        },
+    }
+    SPHINX_RESULT_CACHE = 'sphinx'
+
+File is split to sets of WAYS fixed-size slots. Key hash selects set,
+CLOCK algorithm selects evicted slot of set. Sets are guarded by STRIPES
+byte-range file locks, shared for reads and exclusive for writes, so
+processes wait only for writes to same stripe. Values larger than slot are
+not cached. All processes must use same OPTIONS for LOCATION.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import fcntl
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils import six
+from django.utils.six.moves import cPickle as pickle
+
+MAGIC = b'SPXC'
+VERSION = 1
+
+# magic, version, number of sets, ways, slot size
+_FILE_HEADER = struct.Struct('<4sIIII')
+# CLOCK hand
+_SET_HEADER = struct.Struct('<I')
+# key hash, expiration time (0 for none), key length, value length
+_SLOT = struct.Struct('<8sdII')
+_FLAGS = struct.Struct('<B')
+_FLAGS_OFFSET = _SLOT.size
+_DATA_OFFSET = _SLOT.size + _FLAGS.size
+
+USED = 1
+REFERENCED = 2
+
+# value encodings
+_ENCODED = b'E'
+_PICKLED = b'P'
+
+# row value types
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'i'
+_FLOAT = b'd'
+_BYTES = b'b'
+_TEXT = b'u'
+_LIST = b'l'
+_TUPLE = b't'
+
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_LENGTH = struct.Struct('<I')
+
+
+def _encode(value, parts):
+    if value is None:
+        parts.append(_NONE)
+    elif value is True:
+        parts.append(_TRUE)
+    elif value is False:
+        parts.append(_FALSE)
+    elif isinstance(value, six.integer_types):
+        # struct.error for values out of bigint range
+        parts.append(_INT + _INT64.pack(value))
+    elif isinstance(value, float):
+        parts.append(_FLOAT + _DOUBLE.pack(value))
+    elif isinstance(value, bytes):
+        parts.append(_BYTES + _LENGTH.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+        parts.append(_TEXT + _LENGTH.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        tag = _LIST if isinstance(value, list) else _TUPLE
+        parts.append(tag + _LENGTH.pack(len(value)))
+        for item in value:
+            _encode(item, parts)
+    else:
+        raise TypeError(type(value))
+
+
+def _decode(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT:
+        return _INT64.unpack_from(data, pos)[0], pos + _INT64.size
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    length, = _LENGTH.unpack_from(data, pos)
+    pos += _LENGTH.size
+    if tag == _BYTES:
+        return data[pos:pos + length], pos + length
+    if tag == _TEXT:
+        return data[pos:pos + length].decode('utf-8'), pos + length
+    items = []
+    for _ in range(length):
+        item, pos = _decode(data, pos)
+        items.append(item)
+    return (items if tag == _LIST else tuple(items)), pos
+
+
+def encode_value(value):
+    """ Serializes value, using compact encoding for result sets of rows
+    of numbers and strings and pickle for anything else."""
+    parts = [_ENCODED]
+    try:
+        _encode(value, parts)
+    except (TypeError, struct.error):
+        return _PICKLED + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return b''.join(parts)
+
+
+def decode_value(data):
+    if data[:1] == _PICKLED:
+        return pickle.loads(data[1:])
+    return _decode(data, 1)[0]
+
+
+class MmapCache(BaseCache):
+    """ Cache backend in memory-mapped file.
+
+    OPTIONS:
+        SIZE: file size in bytes (64M by default)
+        SLOT_SIZE: max size of key and encoded value (16K by default)
+        WAYS: slots per set (8 by default)
+        STRIPES: number of locks (64 by default)
+    """
+
+    def __init__(self, location, params):
+        super(MmapCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self.slot_size = int(options.get('SLOT_SIZE', 16384))
+        self.ways = int(options.get('WAYS', 8))
+        self.set_size = _SET_HEADER.size + self.ways * self.slot_size
+        size = int(options.get('SIZE', 64 * 1024 * 1024))
+        self.sets = max(1, (size - _FILE_HEADER.size) // self.set_size)
+        self.stripes = min(int(options.get('STRIPES', 64)), self.sets)
+        self.length = _FILE_HEADER.size + self.sets * self.set_size
+        self._pid = None
+        self._map = None
+        self._fd = None
+        self._locks = []
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # byte 0 guards initialization and clear(), bytes 1..stripes - sets
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(fd).st_size != self.length:
+                os.ftruncate(fd, self.length)
+            m = mmap.mmap(fd, self.length)
+            header = _FILE_HEADER.pack(MAGIC, VERSION, self.sets, self.ways,
+                                       self.slot_size)
+            if m[:_FILE_HEADER.size] != header:
+                self._zero(m)
+                m[:_FILE_HEADER.size] = header
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+        return fd, m
+
+    def _zero(self, m):
+        chunk = 1024 * 1024
+        for pos in range(_FILE_HEADER.size, self.length, chunk):
+            end = min(pos + chunk, self.length)
+            m[pos:end] = b'\0' * (end - pos)
+
+    def _get_map(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._open_lock:
+                if self._pid != pid:
+                    # locks of parent process are not inherited by fork
+                    self._fd, self._map = self._open()
+                    self._locks = [threading.Lock()
+                                   for _ in range(self.stripes)]
+                    self._pid = pid
+        return self._map
+
+    def _locate(self, key):
+        key = key.encode('utf-8')
+        digest = hashlib.md5(key).digest()[:8]
+        index = struct.unpack('<Q', digest)[0] % self.sets
+        return key, digest, index
+
+    def _lock(self, index, exclusive):
+        """ Locks set against other threads and processes."""
+        m = self._get_map()
+        stripe = index % self.stripes
+        self._locks[stripe].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX if exclusive else
+                        fcntl.LOCK_SH, 1, 1 + stripe)
+        except BaseException:
+            self._locks[stripe].release()
+            raise
+        return m, stripe
+
+    def _unlock(self, stripe):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 1 + stripe)
+        finally:
+            self._locks[stripe].release()
+
+    def _slot(self, index, way):
+        return (_FILE_HEADER.size + index * self.set_size +
+                _SET_HEADER.size + way * self.slot_size)
+
+    def _find(self, m, index, key, digest, now):
+        """ Returns position of live slot for key or None."""
+        for way in range(self.ways):
+            pos = self._slot(index, way)
+            flags, = _FLAGS.unpack_from(m, pos + _FLAGS_OFFSET)
+            if not flags & USED or m[pos:pos + 8] != digest:
+                continue
+            _, expires, klen, _ = _SLOT.unpack_from(m, pos)
+            start = pos + _DATA_OFFSET
+            if m[start:start + klen] != key:
+                continue
+            if expires and expires <= now:
+                return None
+            return pos
+        return None
+
+    def _read(self, m, pos):
+        _, _, klen, vlen = _SLOT.unpack_from(m, pos)
+        start = pos + _DATA_OFFSET + klen
+        return m[start:start + vlen]
+
+    def _evict(self, m, index, now):
+        """ Returns position of free, expired or not recently used slot."""
+        for way in range(self.ways):
+            pos = self._slot(index, way)
+            flags, = _FLAGS.unpack_from(m, pos + _FLAGS_OFFSET)
+            expires = _SLOT.unpack_from(m, pos)[1]
+            if not flags & USED or (expires and expires <= now):
+                return pos
+        offset = _FILE_HEADER.size + index * self.set_size
+        hand, = _SET_HEADER.unpack_from(m, offset)
+        while True:
+            way = hand % self.ways
+            hand = way + 1
+            pos = self._slot(index, way)
+            flags, = _FLAGS.unpack_from(m, pos + _FLAGS_OFFSET)
+            if not flags & REFERENCED:
+                _SET_HEADER.pack_into(m, offset, hand)
+                return pos
+            _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, flags & ~REFERENCED)
+
+    def _store(self, m, index, key, digest, data, expires, pos=None):
+        """ Writes entry to slot, returns False if it doesn't fit."""
+        if _DATA_OFFSET + len(key) + len(data) > self.slot_size:
+            return False
+        if pos is None:
+            pos = self._evict(m, index, time.time())
+        _SLOT.pack_into(m, pos, digest, expires or 0, len(key), len(data))
+        start = pos + _DATA_OFFSET
+        m[start:start + len(key)] = key
+        start += len(key)
+        m[start:start + len(data)] = data
+        _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, USED | REFERENCED)
+        return True
+
+    def _set(self, key, value, timeout, version, only_new=False):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expires = self.get_backend_timeout(timeout)
+        data = encode_value(value)
+        key, digest, index = self._locate(key)
+        m, stripe = self._lock(index, exclusive=True)
+        try:
+            now = time.time()
+            pos = self._find(m, index, key, digest, now)
+            if pos is not None and only_new:
+                return False
+            if expires is not None and expires <= now:
+                if pos is not None:
+                    _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, 0)
+                return True
+            if not self._store(m, index, key, digest, data, expires, pos):
+                # stale value must not outlive failed set
+                if pos is not None:
+                    _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, 0)
+            return True
+        finally:
+            self._unlock(stripe)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._set(key, value, timeout, version, only_new=True)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set(key, value, timeout, version)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        key, digest, index = self._locate(key)
+        m, stripe = self._lock(index, exclusive=False)
+        try:
+            pos = self._find(m, index, key, digest, time.time())
+            if pos is None:
+                return default
+            data = self._read(m, pos)
+            # concurrent readers set same bit, so shared lock is enough
+            _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, USED | REFERENCED)
+        finally:
+            self._unlock(stripe)
+        return decode_value(data)
+
+    def incr(self, key, delta=1, version=None):
+        name = self.make_key(key, version=version)
+        self.validate_key(name)
+        key, digest, index = self._locate(name)
+        m, stripe = self._lock(index, exclusive=True)
+        try:
+            pos = self._find(m, index, key, digest, time.time())
+            if pos is None:
+                raise ValueError("Key '%s' not found" % name)
+            value = decode_value(self._read(m, pos)) + delta
+            expires = _SLOT.unpack_from(m, pos)[1]
+            self._store(m, index, key, digest, encode_value(value), expires,
+                        pos)
+            return value
+        finally:
+            self._unlock(stripe)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        key, digest, index = self._locate(key)
+        m, stripe = self._lock(index, exclusive=True)
+        try:
+            pos = self._find(m, index, key, digest, time.time())
+            if pos is not None:
+                _FLAGS.pack_into(m, pos + _FLAGS_OFFSET, 0)
+        finally:
+            self._unlock(stripe)
+
+    def clear(self):
+        m = self._get_map()
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.stripes, 1)
+            try:
+                self._zero(m)
+                m[:_FILE_HEADER.size] = _FILE_HEADER.pack(
+                    MAGIC, VERSION, self.sets, self.ways, self.slot_size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.stripes, 1)
+        finally:
+            for lock in self._locks:
+                lock.release()
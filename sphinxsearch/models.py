@@ -1,17 +1,52 @@
 # coding: utf-8
-from copy import copy
+from collections import OrderedDict
+from copy import copy, deepcopy
+import re
+import threading
 
-from django.conf import settings
-from django.db import connections
+from django.db import connections, router
 from django.db.models import QuerySet
 from django.db.models.expressions import RawSQL
+from django.db.models.sql import AND
+from django.db.models.sql.subqueries import InsertQuery
 
-from sphinxsearch import sql, compat
+from sphinxsearch import aliases, sql, compat, result_cache
+from sphinxsearch.buffer import get_write_buffer
 from sphinxsearch.fields import *
-from sphinxsearch.utils import sphinx_escape
+from sphinxsearch.utils import (sphinx_escape, encode_cursor, decode_cursor,
+                                statement_size, content_hash, to_float32)
+
+JSON_PATH_RE = re.compile(r'^(\w+)([.\[].+)$')
+
+
+class ContentHashStats(object):
+    """ Counters of documents written and skipped by content hash check."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def add(self, written=0, skipped=0):
+        with self._lock:
+            self.written += written
+            self.skipped += skipped
+
+    def stats(self):
+        return {'written': self.written, 'skipped': self.skipped}
+
+    def clear(self):
+        with self._lock:
+            self.written = self.skipped = 0
+
+
+content_hash_stats = ContentHashStats()
 
 
 class SphinxQuerySet(QuerySet):
+    # number of rows in first statement of bulk insert
+    bulk_initial_rows = 100
+
     def __init__(self, model, **kwargs):
         kwargs.setdefault('query', sql.SphinxQuery(model))
         super(SphinxQuerySet, self).__init__(model, **kwargs)
@@ -82,21 +117,455 @@ class SphinxQuerySet(QuerySet):
     def options(self, **kw):
         """ Setup OPTION clause for query."""
         qs = self._clone()
-        try:
-            qs.query.options.update(kw)
-        except AttributeError:
-            qs.query.options = kw
+        # options dict is shared between query clones, so it is copied here
+        options = dict(getattr(qs.query, 'options', None) or {})
+        options.update(kw)
+        qs.query.options = options
         return qs
 
+    def batch_with(self, *querysets):
+        """ Evaluates queryset together with other querysets in one round trip.
+
+        :returns: list of evaluated querysets, starting with self.
+        :rtype: list
+        """
+        return batch(self, *querysets)
+
     def with_meta(self):
-        """ Force call SHOW META after fetching queryset data from searchd."""
+        """ Requests SHOW META in same round trip with fetching queryset data.
+
+        Parsed result is available as queryset.meta (sphinxsearch.sql.SphinxMeta
+        instance) after evaluating queryset. Statements are sent as one
+        multi-statement request, enabled by sphinx backend connection flags.
+        """
         qs = self._clone()
         qs.query.with_meta = True
         return qs
 
+    def search_after(self, cursor=None):
+        """ Keyset pagination: returns matches following cursor position.
+
+        Queryset ordering (fields or extra select aliases) is completed with
+        primary key to make sort keys unique; match queries without ordering
+        are sorted by WEIGHT() first. Next page is selected with range
+        condition on sort keys, so searchd doesn't need to sort matches
+        skipped by previous pages.
+
+        >>> page = qs.search_after(cursor)[:20]
+        >>> hits, cursor = list(page), page.next_cursor
+
+        :param cursor: queryset.next_cursor value of previous page, None
+            for first page
+        :type cursor: str
+        :return: new queryset with keyset ordering and condition
+        :rtype: SphinxQuerySet
+        """
+        qs = self._clone()
+        query = qs.query
+        ordering = list(query.order_by)
+        if not ordering and query.default_ordering:
+            ordering = list(self.model._meta.ordering)
+        if not ordering and getattr(query, 'match', None):
+            if 'weight' not in query.extra_select:
+                qs = qs.extra(select={'weight': 'WEIGHT()'})
+            ordering = ['-weight']
+        for name in ordering:
+            if not isinstance(name, six.string_types) or name == '?':
+                raise ValueError("search_after() supports ordering by fields "
+                                 "and extra select aliases only")
+        pk = self.model._meta.pk
+        if not ordering or ordering[-1].lstrip('-') not in ('pk', pk.name):
+            ordering.append('pk')
+        qs = qs.order_by(*ordering)
+        qs.query.keyset_ordering = ordering
+
+        if cursor is None:
+            return qs
+
+        values = decode_cursor(cursor)
+        if len(values) != len(ordering):
+            raise ValueError("Cursor doesn't match queryset ordering")
+        # float attributes are stored with single precision, so only rounded
+        # cursor values are equal to stored ones
+        values = [to_float32(v) if qs.__is_float_key(name) and
+                  isinstance(v, (float,) + six.integer_types) else v
+                  for name, v in zip(ordering, values)]
+        conditions = []
+        params = []
+        keys = [qs.__get_keyset_key(name) for name in ordering]
+        for i, (expr, _, desc) in enumerate(keys):
+            terms = ['%s = %%s' % e for e, _, _ in keys[:i]]
+            terms.append('%s %s %%s' % (expr, '<' if desc else '>'))
+            conditions.append('(%s)' % ' AND '.join(terms))
+            params.extend(values[:i + 1])
+        return qs.extra(where=[' OR '.join(conditions)], params=params)
+
+    @property
+    def next_cursor(self):
+        """ Cursor for search_after() pointing past the last fetched match.
+
+        None is returned if there are no more matches.
+        """
+        ordering = getattr(self.query, 'keyset_ordering', None)
+        if ordering is None:
+            raise ValueError("Queryset is not paginated with search_after()")
+        self._fetch_all()
+        if not self._result_cache:
+            return None
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        if (high_mark is not None and
+                len(self._result_cache) < high_mark - low_mark):
+            return None
+        row = self._result_cache[-1]
+        values = []
+        for name in ordering:
+            _, attname, _ = self.__get_keyset_key(name)
+            if isinstance(row, dict):
+                value = row[attname]
+            else:
+                value = getattr(row, attname)
+            if attname not in self.query.extra_select:
+                field = self.model._meta.get_field(attname)
+                value = field.get_prep_value(value)
+            values.append(value)
+        return encode_cursor(values)
+
+    def __is_float_key(self, name):
+        """ Checks if sort key is float attribute."""
+        name = name.lstrip('-')
+        if name in self.query.extra_select or name == 'pk':
+            return False
+        field = self.model._meta.get_field(name)
+        return (isinstance(field, models.FloatField) and
+                not isinstance(field, SphinxDateTimeField))
+
+    def __get_keyset_key(self, name):
+        """ Returns (expression, attribute name, descending) for sort key."""
+        desc = name.startswith('-')
+        name = name.lstrip('-')
+        if name in self.query.extra_select:
+            return self.query.extra_select[name][0], name, desc
+        if name == 'pk':
+            field = self.model._meta.pk
+        else:
+            field = self.model._meta.get_field(name)
+        return field.column, field.attname, desc
+
+    def iter_all(self, chunk_size=1000, prefetch=False):
+        """ Iterates over all matches in id order with bounded memory usage.
+
+        Unlike iterator(), is not limited with max_matches: matches are
+        fetched with "id > last_id" chunks of chunk_size rows.
+
+        :param chunk_size: number of matches fetched by each query
+        :type chunk_size: int
+        :param prefetch: fetch next chunk in background thread while current
+            one is processed
+        :type prefetch: bool
+        :return: model instances generator
+        """
+        for chunk in self.iter_chunks(chunk_size, prefetch=prefetch):
+            for obj in chunk:
+                yield obj
+
+    def iter_chunks(self, chunk_size=1000, prefetch=False):
+        """ Same as iter_all(), but yields lists of matches."""
+        qs = self.order_by('pk').options(max_matches=chunk_size)
+
+        def fetch(last_pk):
+            chunk = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+            return list(chunk[:chunk_size])
+
+        if prefetch:
+            return _iter_chunks_prefetch(fetch, chunk_size, qs.db)
+        return _iter_chunks(fetch, chunk_size)
+
+    def update(self, **kwargs):
+        """ Updates matched documents.
+
+        searchd can't UPDATE string, JSON and full-text fields, so if any of
+        them is changed and values for all full-text fields are passed,
+        documents are updated with replace_update().
+        """
+        meta = self.model._meta
+        excluded = getattr(self.model, '_excluded_update_fields',
+                           SphinxModel._excluded_update_fields)
+        text_fields = [f.name for f in meta.concrete_fields
+                       if isinstance(f, SphinxField) and not f.primary_key]
+        if (all(name in kwargs for name in text_fields) and
+                any(isinstance(meta.get_field(name), excluded)
+                    for name in kwargs)):
+            return self.replace_update(kwargs)
+        if self.model.content_hash_field:
+            # stored hash doesn't match updated documents anymore
+            kwargs.setdefault(self.model.content_hash_field, 0)
+        return super(SphinxQuerySet, self).update(**kwargs)
+
+    update.alters_data = True
+
+    def replace_update(self, values, chunk_size=1000):
+        """ Updates matched documents with multi-row REPLACE statements.
+
+        Documents are fetched with id chunks, updated with new values and
+        written back as full documents. searchd doesn't return full-text
+        fields, so values for all of them must be passed.
+
+        :param values: dict of new field values
+        :type values: dict
+        :param chunk_size: number of documents fetched and replaced at once
+        :type chunk_size: int
+        :returns: number of replaced documents
+        :rtype: int
+        """
+        meta = self.model._meta
+        fields = [meta.get_field(name) for name in values]
+        for field, value in zip(fields, values.values()):
+            if hasattr(value, 'resolve_expression'):
+                raise ValueError("Expressions are not supported in "
+                                 "REPLACE update: %s" % field.name)
+        text_fields = [f.name for f in meta.concrete_fields
+                       if isinstance(f, SphinxField) and not f.primary_key]
+        missing = [name for name in text_fields if name not in values]
+        if missing:
+            raise ValueError("Full-text fields are not returned by searchd "
+                             "and must be updated too: %s"
+                             % ', '.join(missing))
+
+        qs = self.defer(None)
+        if text_fields:
+            qs = qs.defer(*text_fields)
+        count = 0
+        for chunk in qs.iter_chunks(chunk_size):
+            for obj in chunk:
+                for field, value in zip(fields, values.values()):
+                    setattr(obj, field.attname, value)
+            qs.bulk_replace(chunk)
+            count += len(chunk)
+        return count
+
+    replace_update.alters_data = True
+
+    def bulk_replace(self, objs, batch_size=None):
+        """ Inserts or replaces documents with multi-row REPLACE statements.
+
+        Works like bulk_create(), but existing documents with same ids are
+        replaced.
+
+        Documents of models with content_hash_field are skipped if their
+        content hash equals to one stored in index.
+
+        :param objs: list of model instances
+        :param batch_size: max number of documents in one statement, by
+            default limited by searchd max_packet_size only
+        :returns: objs
+        :raises ValueError: some of documents have deferred fields, which
+            would be erased by REPLACE
+        """
+        for obj in objs:
+            deferred = obj.get_deferred_fields()
+            if deferred:
+                raise ValueError(
+                    "Can't replace %s with deferred fields: %s" % (
+                        self.model.__name__, ', '.join(sorted(deferred))))
+        qs = self._clone()
+        qs._replace = True
+        changed = objs
+        if self.model.content_hash_field:
+            changed = qs._filter_changed(objs)
+        if changed:
+            qs.bulk_create(changed, batch_size=batch_size)
+        return objs
+
+    def _filter_changed(self, objs, chunk_size=1000):
+        """ Sets content hash for documents, returning changed ones."""
+        field = self.model.content_hash_field
+        changed = []
+        for i in range(0, len(objs), chunk_size):
+            chunk = objs[i:i + chunk_size]
+            ids = [obj.pk for obj in chunk]
+            # stored hashes are not limited by filters of this queryset
+            qs = SphinxQuerySet(self.model, using=self.db)
+            stored = dict(qs.filter(pk__in=ids).values_list('pk', field)
+                          .options(max_matches=max(len(ids), 1000))
+                          [:len(ids)])
+            for obj in chunk:
+                setattr(obj, field, obj.get_content_hash())
+                if stored.get(obj.pk) != getattr(obj, field):
+                    changed.append(obj)
+        content_hash_stats.add(written=len(changed),
+                               skipped=len(objs) - len(changed))
+        return changed
+
+    def _batched_insert(self, objs, fields, batch_size, *args, **kwargs):
+        """ Inserts objects with multi-row INSERT (or REPLACE) statements.
+
+        Number of rows in statement is adjusted to fit searchd
+        max_packet_size, small statements are sent several per round trip.
+        """
+        connection = connections[self.db]
+        limit = connection.max_statement_size
+        rows = batch_size or self.bulk_initial_rows
+        pos = 0
+        with connection.pipeline() as pipeline:
+            while pos < len(objs):
+                chunk = objs[pos:pos + rows]
+                query = InsertQuery(self.model)
+                query.insert_values(fields, chunk)
+                query.replace = getattr(self, '_replace', False)
+                (sql, params), = query.get_compiler(using=self.db).as_sql()
+                size = statement_size(sql, params)
+                if size > limit and len(chunk) > 1:
+                    # too large statement, retry with smaller chunk
+                    rows = max(1, len(chunk) * limit // size // 2)
+                    continue
+                pipeline.add(sql, params, size)
+                pos += len(chunk)
+                # next chunk size is estimated from average row size
+                rows = max(1, int(len(chunk) * limit * 0.9 / size))
+                if batch_size:
+                    rows = min(rows, batch_size)
+        result_cache.bump_generation(
+            aliases.resolve(self.model._meta.db_table))
+        # sphinxsearch can't return ids of inserted documents
+        return []
+
+    def bulk_delete(self, ids=None, batch_size=1000, progress=None):
+        """ Deletes documents with bounded batches.
+
+        Each batch is deleted with separate statement, so RT index is not
+        locked for long time. Batches of consecutive ids are deleted with
+        "id BETWEEN first AND last" condition, others with "id IN (...)".
+
+        :param ids: ids of documents to delete; by default ids of matched
+            documents are fetched with id chunks, not limited by max_matches
+        :param batch_size: max number of documents deleted by one statement
+        :type batch_size: int
+        :param progress: callable receiving number of processed ids and
+            number of deleted documents after each batch
+        :returns: number of deleted documents
+        :rtype: int
+        """
+        if ids is None:
+            chunks = ([obj.pk for obj in chunk] for chunk in
+                      self.only('pk').iter_chunks(batch_size))
+        else:
+            ids = sorted(set(ids))
+            chunks = (ids[i:i + batch_size]
+                      for i in range(0, len(ids), batch_size))
+
+        connection = connections[self.db]
+        index = aliases.resolve(self.model._meta.db_table)
+        table = connection.ops.quote_name(index)
+        column = self.model._meta.pk.column
+        processed = deleted = 0
+        with connection.cursor() as cursor:
+            for batch in chunks:
+                if not batch:
+                    continue
+                first, last = batch[0], batch[-1]
+                if (len(batch) > 1 and
+                        isinstance(first, six.integer_types) and
+                        last - first + 1 == len(batch)):
+                    sql = 'DELETE FROM %s WHERE %s BETWEEN %%s AND %%s' % (
+                        table, column)
+                    params = [first, last]
+                else:
+                    sql = 'DELETE FROM %s WHERE %s IN (%s)' % (
+                        table, column, ', '.join(['%s'] * len(batch)))
+                    params = batch
+                cursor.execute(sql, params)
+                result_cache.bump_generation(index)
+                processed += len(batch)
+                deleted += max(cursor.rowcount, 0)
+                if progress is not None:
+                    progress(processed, deleted)
+        return deleted
+
+    bulk_delete.alters_data = True
+
+    def count_strategy(self, strategy):
+        """ Sets up how count() computes number of matches.
+
+        :param strategy: "exact" performs COUNT(*) query, "meta" takes
+            total_found from SHOW META, "auto" uses total_found except for
+            grouped or distinct queries where it may be approximate.
+            Default is taken from settings.SPHINX_COUNT_STRATEGY ("exact").
+        :type strategy: str
+        :return: new queryset with count strategy
+        :rtype: SphinxQuerySet
+        """
+        if strategy not in sql.COUNT_STRATEGIES:
+            raise ValueError("Invalid count strategy: %s" % strategy)
+        qs = self._clone()
+        qs.query.count_strategy = strategy
+        return qs
+
+    def cache(self, ttl=60, alias=None):
+        """ Caches fetched rows, FACET and SHOW META results.
+
+        Cached results are not used after any write to index.
+
+        :param ttl: cache timeout in seconds
+        :param alias: django cache name, settings.SPHINX_RESULT_CACHE
+            ('default') by default
+        :return: new queryset with cached results
+        :rtype: SphinxQuerySet
+        """
+        qs = self._clone()
+        qs.query.result_cache = (ttl, alias)
+        return qs
+
+    def facet(self, *args, **kwargs):
+        """ Requests FACET result sets fetched together with queryset data.
+
+        :param args: list of fields, extra select aliases or JSON attribute
+            paths (i.e. "attr_json.key") to build facets for
+        :type args: list-like
+
+        Keyword params:
+        :param limit: max number of values returned for each facet
+        :type limit: int
+        :param order_by: ordering of facet values, field name or "count"
+            with optional "-" prefix for descending order
+        :type order_by: str
+        :return: new queryset with facets
+        :rtype: SphinxQuerySet
+
+        Facet values are available as queryset.facets after evaluating
+        queryset, an ordered dict of {name: [(value, count), ...]}.
+        """
+        limit = kwargs.get('limit')
+        order_by = kwargs.get('order_by')
+
+        order_sql = ''
+        if order_by:
+            desc = order_by.startswith('-')
+            order_name = order_by.lstrip('-')
+            if order_name == 'count':
+                order_expr = 'COUNT(*)'
+            elif '(' in order_name:
+                # expression like FACET()
+                order_expr = order_name
+            else:
+                order_expr = self.__get_attr_expression(order_name)
+            order_sql = ' ORDER BY %s %s' % (order_expr,
+                                             'DESC' if desc else 'ASC')
+        limit_sql = ' LIMIT %d' % int(limit) if limit is not None else ''
+
+        qs = self._clone()
+        facets = list(getattr(qs.query, 'facets', None) or ())
+        for field_name in args:
+            facet_sql = 'FACET %s%s%s' % (
+                self.__get_attr_expression(field_name), order_sql, limit_sql)
+            facets = [f for f in facets if f[0] != field_name]
+            facets.append((field_name, facet_sql))
+        qs.query.facets = facets
+        return qs
+
     def group_by(self, *args, **kwargs):
         """
-        :param args: list of fields to group by
+        :param args: list of fields, extra select aliases or JSON attribute
+            paths (i.e. "attr_json.key") to group by
         :type args: list-like
 
         Keyword params:
@@ -135,15 +604,29 @@ class SphinxQuerySet(QuerySet):
         qs = self._clone()
         qs.query.group_by = qs.query.group_by or []
         for field_name in args:
-            if field_name not in qs.query.extra_select:
+            if (field_name in qs.query.extra_select or
+                    JSON_PATH_RE.match(field_name)):
+                expression = self.__get_attr_expression(field_name)
+                qs.query.group_by.append(RawSQL(expression, []))
+            else:
                 field = self.model._meta.get_field(field_name)
                 qs.query.group_by.append(field.attname)
-            else:
-                qs.query.group_by.append(RawSQL(field_name, []))
         qs.query.group_limit = group_limit
         qs.query.group_order_by = group_order_by
         return qs
 
+    def __get_attr_expression(self, name):
+        """ Returns SphinxQL expression for field, extra select alias or JSON
+        attribute path."""
+        if name in self.query.extra_select:
+            return name
+        json_path = JSON_PATH_RE.match(name)
+        if json_path:
+            # JSON attribute key, i.e. "attr_json.key"
+            attr_name, path = json_path.groups()
+            return self.model._meta.get_field(attr_name).column + path
+        return self.model._meta.get_field(name).column
+
     def __check_mva_field_lookup(self, field, lookup, value, negate):
         """ Replaces some MVA field lookups with valid sphinx expressions."""
 
@@ -180,12 +663,9 @@ class SphinxQuerySet(QuerySet):
             return False
         if not isinstance(value, (tuple, list)):
             value = [value]
-        placeholders = ', '.join(['%s'] * len(value))
-        condition = "IN(%s, %s)" % (field.column, placeholders)
         value = [field.get_prep_value(v) for v in value]
-        if negate:
-            condition = "NOT (%s)" % condition
-        self.query.add_extra(None, None, [condition], value, None, None)
+        self.query.where.add(sql.SphinxExtraIn(field.column, value, negate),
+                             AND)
         return True
 
     def __check_sphinx_field_exact(self, field, lookup, value, negate):
@@ -198,30 +678,119 @@ class SphinxQuerySet(QuerySet):
         self.query.add_match(**{field.name: value})
         return True
 
-    def _fetch_meta(self):
-        c = connections[settings.SPHINX_DATABASE_NAME].cursor()
-        try:
-            c.execute("SHOW META")
-            self.meta = dict([c.fetchone()])
-        except UnicodeDecodeError:
-            self.meta = {}
-        finally:
-            c.close()
+    def _fetch_extra_results(self):
+        # FACET and SHOW META results are fetched together with SELECT by
+        # compiler
+        query = self.query
+        facets = getattr(query, 'facets', None)
+        if facets:
+            fetched = getattr(query, 'fetched_facets', None)
+            if fetched is None:
+                fetched = OrderedDict((name, []) for name, _ in facets)
+            self.facets = fetched
+        if getattr(query, 'with_meta', False):
+            meta = getattr(query, 'fetched_meta', None)
+            self.meta = meta if meta is not None else sql.SphinxMeta()
 
     def iterator(self):
         for row in super(SphinxQuerySet, self).iterator():
             yield row
-        if getattr(self.query, 'with_meta', False):
-            self._fetch_meta()
+        self._fetch_extra_results()
 
     if compat.DJ_11:
         # Django-1.11 does not use iterator() call when materializing, so
-        # with_meta() should be handled separately.
+        # facet() and with_meta() should be handled separately.
 
         def _fetch_all(self):
             super(SphinxQuerySet, self)._fetch_all()
-            if getattr(self.query, 'with_meta', False):
-                self._fetch_meta()
+            self._fetch_extra_results()
+
+
+def _iter_chunks(fetch, chunk_size):
+    """ Yields chunks returned by fetch(last_pk) until last one."""
+    last_pk = None
+    while True:
+        chunk = fetch(last_pk)
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+
+def _iter_chunks_prefetch(fetch, chunk_size, using):
+    """ Yields chunks like _iter_chunks, fetching next chunk in background
+    thread while current one is processed."""
+    requests = six.moves.queue.Queue()
+    results = six.moves.queue.Queue()
+    stop = object()
+
+    def worker():
+        try:
+            while True:
+                last_pk = requests.get()
+                if last_pk is stop:
+                    break
+                try:
+                    results.put((fetch(last_pk), None))
+                except Exception as e:
+                    results.put((None, e))
+        finally:
+            # worker thread has its own database connection
+            connections[using].close()
+
+    thread = threading.Thread(target=worker, name='sphinxsearch-iter-all')
+    thread.daemon = True
+    thread.start()
+    try:
+        requests.put(None)
+        while True:
+            chunk, exc = results.get()
+            if exc is not None:
+                raise exc
+            if len(chunk) == chunk_size:
+                requests.put(chunk[-1].pk)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                break
+    finally:
+        requests.put(stop)
+
+
+def batch(*querysets):
+    """ Evaluates several querysets with one multi-statement query.
+
+    SELECT statements for all querysets are sent to searchd in one round trip
+    (one per database connection), fetched result sets are stored to each
+    queryset's result cache.
+
+    >>> hits, sidebar = batch(qs.match('text')[:20], qs.group_by('category'))
+
+    :returns: list of evaluated querysets
+    :rtype: list
+    """
+    pending = OrderedDict()
+    for qs in querysets:
+        if not isinstance(qs.query, sql.SphinxQuery):
+            raise TypeError("batch() accepts only SphinxQuerySet instances")
+        if qs._result_cache is not None:
+            continue
+        statements = qs.query.get_compiler(qs.db).get_multi_statements()
+        pending.setdefault(qs.db, []).append((qs, statements))
+
+    for db, items in pending.items():
+        results = iter(connections[db].execute_multi(
+            [s for _, statements in items for s in statements]))
+        for qs, statements in items:
+            query = qs.query
+            query.fetched_rows = query.set_fetched_results(
+                results if statements else None)
+            try:
+                qs._fetch_all()
+            finally:
+                del query.fetched_rows
+    return list(querysets)
 
 
 class SphinxManager(models.Manager):
@@ -252,6 +821,9 @@ class SphinxManager(models.Manager):
     def group_by(self, *args, **kw):
         return self.get_queryset().group_by(*args, **kw)
 
+    def bulk_replace(self, *args, **kw):
+        return self.get_queryset().bulk_replace(*args, **kw)
+
     def get(self, *args, **kw):
         return self.get_queryset().get(*args, **kw)
 
@@ -266,3 +838,171 @@ class SphinxModel(six.with_metaclass(sql.SphinxModelBase, models.Model)):
         models.CharField,
         models.TextField
     )
+
+    # name of bigint attribute keeping hash of other document fields;
+    # documents with unchanged content are not written
+    content_hash_field = None
+
+    def get_content_hash(self):
+        """ Returns hash of document field values.
+
+        Deferred fields are skipped, so hash of document loaded from index
+        without full-text fields differs from stored one.
+        """
+        deferred = self.get_deferred_fields()
+        values = []
+        for field in self._meta.concrete_fields:
+            if (field.primary_key or field.name == self.content_hash_field or
+                    field.attname in deferred):
+                continue
+            value = field.get_prep_value(getattr(self, field.attname))
+            if (isinstance(field, models.FloatField) and
+                    not isinstance(field, SphinxDateTimeField) and
+                    value is not None):
+                # searchd keeps float attributes with single precision
+                value = to_float32(value)
+            values.append(value)
+        return content_hash(values)
+
+    def _content_changed(self):
+        """ Updates content hash, checking if document differs from stored
+        one.
+
+        Content of documents with deferred full-text fields is unknown, so
+        they are always written; their hash is reset if any field is changed.
+        """
+        field = self.content_hash_field
+        if self.get_deferred_fields():
+            if self.get_dirty_fields() != []:
+                setattr(self, field, 0)
+            return True
+        stored = getattr(self, field)
+        setattr(self, field, self.get_content_hash())
+        return self._state.adding or stored != getattr(self, field)
+
+    def get_deferred_fields(self):
+        """ Returns attnames of fields not loaded from index.
+
+        Same as in Django>=1.10: fields set after loading are not deferred
+        anymore, unlike Django-1.8 deferred classes.
+        """
+        return {f.attname for f in self._meta.concrete_fields
+                if f.attname not in self.__dict__}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(SphinxModel, cls).from_db(db, field_names, values)
+        # search results are mostly read-only, values are copied on first
+        # change only
+        instance._snapshot_pending = True
+        return instance
+
+    def __setattr__(self, name, value):
+        # annotations are set to each search result and are not tracked
+        if name in self.__dict__ and self.__dict__.get('_snapshot_pending'):
+            self._take_snapshot()
+        super(SphinxModel, self).__setattr__(name, value)
+
+    def _take_snapshot(self):
+        """ Remembers field values to find fields changed before save()."""
+        self.__dict__['_snapshot_pending'] = False
+        snapshot = {}
+        for field in self._meta.concrete_fields:
+            # deferred fields are not in instance dict
+            if field.attname in self.__dict__:
+                value = self.__dict__[field.attname]
+                if isinstance(value, (list, dict)):
+                    value = deepcopy(value)
+                snapshot[field.attname] = value
+        self._loaded_values = snapshot
+
+    def get_dirty_fields(self):
+        """ Returns names of fields changed since document was loaded or
+        saved, or None if document state is unknown.
+
+        Search results are copied on first attribute assignment, so MVA and
+        JSON values changed in place before it are not tracked.
+        """
+        if self.__dict__.get('_snapshot_pending'):
+            return []
+        snapshot = getattr(self, '_loaded_values', None)
+        if snapshot is None:
+            return None
+        missing = object()
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in self.__dict__ and
+                snapshot.get(field.attname, missing) !=
+                self.__dict__[field.attname]]
+
+    def _get_update_fields(self):
+        """ Returns changed fields if they can be updated in place, None if
+        document must be replaced."""
+        dirty = self.get_dirty_fields()
+        if dirty is None:
+            return None
+        for name in dirty:
+            field = self._meta.get_field(name)
+            if field.primary_key or isinstance(field,
+                                               self._excluded_update_fields):
+                return None
+        return dirty
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        """ Saves document, adding it to write buffer if it is enabled.
+
+        Documents loaded from index are not written if content_hash_field is
+        set and their content is not changed. If only fixed-width attributes
+        of loaded document are changed, they are updated in place with UPDATE
+        statement instead of replacing whole document.
+
+        Only documents with all fields populated are buffered; documents with
+        deferred fields and saves with update_fields are written directly.
+        """
+        hashed = self.content_hash_field and update_fields is None
+        if self.content_hash_field and update_fields:
+            # partially updated document doesn't match stored hash anymore
+            setattr(self, self.content_hash_field, 0)
+            update_fields = list(update_fields) + [self.content_hash_field]
+        if hashed and not self._content_changed():
+            content_hash_stats.add(skipped=1)
+            return
+        using = using or router.db_for_write(self.__class__, instance=self)
+        write_buffer = get_write_buffer(using)
+        # buffered REPLACE needs all fields, documents loaded from index don't
+        # have full-text fields and are updated directly
+        direct = (update_fields is not None or
+                  bool(self.get_deferred_fields()))
+        if write_buffer is None or direct:
+            if write_buffer is not None:
+                # pending write of same document must not override update
+                write_buffer.flush_document(self._meta.concrete_model,
+                                            self.pk)
+            if hashed:
+                content_hash_stats.add(written=1)
+            if (update_fields is None and not force_insert and
+                    not self._state.adding):
+                update_fields = self._get_update_fields()
+            super(SphinxModel, self).save(
+                force_insert=force_insert, force_update=force_update,
+                using=using, update_fields=update_fields)
+        else:
+            write_buffer.replace(self)
+            self._state.db = using
+            self._state.adding = False
+        self._take_snapshot()
+
+    save.alters_data = True
+
+    def delete(self, using=None, *args, **kwargs):
+        """ Deletes document, adding it to write buffer if it is enabled."""
+        using = using or router.db_for_write(self.__class__, instance=self)
+        write_buffer = get_write_buffer(using)
+        if write_buffer is None:
+            return super(SphinxModel, self).delete(using, *args, **kwargs)
+        write_buffer.delete(self._meta.concrete_model, self.pk)
+        # same result as Model.delete() on Django>=1.9
+        label = '%s.%s' % (self._meta.app_label, self._meta.object_name)
+        return 1, {label: 1}
+
+    delete.alters_data = True
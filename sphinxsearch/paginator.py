@@ -0,0 +1,98 @@
+# coding: utf-8
+from math import ceil
+
+from django.conf import settings
+from django.core.paginator import (Paginator, Page, PageNotAnInteger,
+                                   EmptyPage)
+
+
+class SphinxPaginator(Paginator):
+    """ Paginator fetching page hits and total_found in one round trip.
+
+    searchd doesn't return matches past max_matches result window, so number
+    of pages is limited by it. For pages ending past default max_matches
+    OPTION max_matches is raised automatically up to max_matches_limit;
+    pages beyond this window raise EmptyPage.
+
+    :param max_matches: searchd max_matches value used without OPTION,
+        settings.SPHINX_MAX_MATCHES (1000) by default
+    :param max_matches_limit: max value for OPTION max_matches set by
+        paginator, settings.SPHINX_MAX_MATCHES_LIMIT (10000) by default
+    """
+
+    default_max_matches = 1000
+    default_max_matches_limit = 10000
+
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, max_matches=None,
+                 max_matches_limit=None):
+        if max_matches is None:
+            max_matches = getattr(settings, 'SPHINX_MAX_MATCHES',
+                                  self.default_max_matches)
+        if max_matches_limit is None:
+            max_matches_limit = getattr(settings, 'SPHINX_MAX_MATCHES_LIMIT',
+                                        self.default_max_matches_limit)
+        options = getattr(object_list.query, 'options', None) or {}
+        self.max_matches = options.get('max_matches', max_matches)
+        self.max_matches_limit = max(max_matches_limit, self.max_matches)
+        self.total_found = None
+        super(SphinxPaginator, self).__init__(
+            object_list, per_page, orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page)
+        self._count = None
+
+    def _check_object_list_is_ordered(self):
+        # searchd sorts matches by relevance if no ordering is set
+        pass
+
+    @property
+    def count(self):
+        """ Returns number of matches reachable within max_matches window."""
+        if self._count is None:
+            qs = self.object_list.count_strategy('meta')
+            self._set_total_found(qs.count())
+        return self._count
+
+    @property
+    def num_pages(self):
+        if self.count == 0 and not self.allow_empty_first_page:
+            return 0
+        hits = max(1, self.count - self.orphans)
+        return int(ceil(hits / float(self.per_page)))
+
+    def _set_total_found(self, total_found):
+        self.total_found = total_found
+        self._count = min(total_found, self.max_matches_limit)
+
+    def page(self, number):
+        """ Returns a Page object for the given 1-based page number.
+
+        Page hits and total_found are fetched with single query.
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        bottom = (number - 1) * self.per_page
+        if bottom >= self.max_matches_limit:
+            raise EmptyPage('That page is beyond max_matches=%d result window'
+                            % self.max_matches_limit)
+
+        # orphans are fetched with page and dropped if page is not the last
+        top = min(bottom + self.per_page + self.orphans,
+                  self.max_matches_limit)
+        qs = self.object_list[bottom:top].with_meta()
+        if top > self.max_matches:
+            qs = qs.options(max_matches=top)
+        object_list = list(qs)
+        self._set_total_found(qs.meta.total_found)
+
+        if number > self.num_pages and not (
+                number == 1 and self.allow_empty_first_page):
+            raise EmptyPage('That page contains no results')
+        if bottom + self.per_page + self.orphans < self.count:
+            object_list = object_list[:self.per_page]
+        # Paginator._get_page() is available since Django-1.11
+        return Page(object_list, number, self)
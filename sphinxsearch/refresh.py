@@ -0,0 +1,190 @@
+# coding: utf-8
+""" Refresh-ahead of hot cached search results."""
+import hashlib
+import heapq
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from sphinxsearch import result_cache
+
+logger = logging.getLogger('sphinxsearch.refresh')
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+class HotQuery(object):
+    """ Query cached with SphinxQuerySet.cache() and its hit counter."""
+
+    def __init__(self, index, using, alias, ttl, statements):
+        self.index = index
+        self.using = using
+        self.alias = alias
+        self.ttl = ttl
+        self.statements = statements
+        self.hits = 0
+        self.expires = None
+
+
+class RefreshAhead(object):
+    """ Re-executes most frequently used cached queries before their results
+    expire.
+
+    Evaluations of querysets with cache() are counted per query; counters
+    are halved every interval seconds, so they follow current hit rate and
+    queries not used anymore are forgotten. Every interval background thread
+    selects top queries by hits and re-executes ones expiring within ahead
+    seconds, at most concurrency of them at once, storing fresh results with
+    same ttl.
+    """
+
+    def __init__(self, top=100, ahead=5.0, interval=1.0, concurrency=2,
+                 max_tracked=10000):
+        self.top = top
+        self.ahead = ahead
+        self.interval = interval
+        self.concurrency = concurrency
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pool = None
+        self.refreshed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @staticmethod
+    def get_fingerprint(using, alias, statements):
+        return hashlib.md5(repr((using, alias, statements)).encode('utf-8')
+                           ).hexdigest()
+
+    def track(self, index, using, alias, ttl, statements, expires):
+        """ Counts evaluation of cached query.
+
+        :param expires: expiration timestamp of cached results
+        """
+        if ttl is None:
+            return
+        fingerprint = self.get_fingerprint(using, alias, statements)
+        with self._lock:
+            query = self._queries.get(fingerprint)
+            if query is None:
+                if len(self._queries) >= self.max_tracked:
+                    return
+                query = self._queries[fingerprint] = HotQuery(
+                    index, using, alias, ttl, statements)
+            query.hits += 1
+            query.expires = expires
+
+    def get_due(self, now=None):
+        """ Returns hot queries with results expiring soon, decaying hit
+        counters."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            queries = list(self._queries.items())
+            hot = heapq.nlargest(self.top, queries, key=lambda q: q[1].hits)
+            for fingerprint, query in queries:
+                query.hits //= 2
+                if not query.hits:
+                    del self._queries[fingerprint]
+        return [query for _, query in hot
+                if query.expires is not None and
+                query.expires - now <= self.ahead]
+
+    def refresh(self, query):
+        """ Re-executes query, storing fresh results to cache.
+
+        :returns: False if query is refreshed by another process
+        :rtype: bool
+        """
+        from django.db import connections
+        key = result_cache.make_key(query.index, query.using,
+                                    query.statements)
+        cache = result_cache.get_cache(query.alias)
+        # only one process refreshes results
+        if not cache.add(key + ':refresh', 1, self.ahead):
+            return False
+        results = connections[query.using].execute_multi(query.statements)
+        query.expires = result_cache.set_results(cache, key, results,
+                                                 query.ttl)
+        return True
+
+    def _refresh(self, query):
+        from django.db import connections
+        try:
+            refreshed = self.refresh(query)
+        except Exception:
+            logger.exception("Failed to refresh cached sphinxsearch results")
+            refreshed = None
+        finally:
+            # pool threads keep own connections
+            connections[query.using].close_if_unusable_or_obsolete()
+        with self._lock:
+            if refreshed is None:
+                self.failed += 1
+            elif refreshed:
+                self.refreshed += 1
+            else:
+                self.skipped += 1
+
+    def start(self):
+        self._stopped.clear()
+        self._pool = ThreadPool(self.concurrency)
+        self._thread = threading.Thread(target=self._run,
+                                        name='sphinxsearch-refresh-ahead')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops background thread, waiting for running refreshes."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            # pool threads execute at most concurrency queries at once
+            self._pool.map(self._refresh, self.get_due())
+
+    def stats(self):
+        return {'tracked': len(self._queries), 'refreshed': self.refreshed,
+                'skipped': self.skipped, 'failed': self.failed}
+
+
+def enable_refresh_ahead(**kwargs):
+    """ Starts refreshing hot cached queries in current process.
+
+    Keyword arguments are passed to RefreshAhead.
+
+    :returns: started refresher
+    :rtype: RefreshAhead
+    """
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = RefreshAhead(**kwargs)
+            _refresher.start()
+        return _refresher
+
+
+def disable_refresh_ahead():
+    """ Stops refreshing hot cached queries."""
+    global _refresher
+    with _refresher_lock:
+        refresher, _refresher = _refresher, None
+    if refresher is not None:
+        refresher.stop()
+
+
+def get_refresher():
+    """ Returns active refresher or None."""
+    return _refresher
@@ -0,0 +1,104 @@
+# coding: utf-8
+""" Search results cache invalidated by per-index write generations.
+
+Each write to index increments its generation number, which is a part of
+cache keys of search results, so results cached before write are not used
+anymore. Generation numbers are kept in django cache set by
+settings.SPHINX_RESULT_CACHE ('default' by default), which should be shared
+by all processes writing to index.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from sphinxsearch.singleflight import flights
+
+GENERATION_KEY = 'sphinxsearch:generation:%s'
+RESULT_KEY = 'sphinxsearch:result:%s:%s:%s'
+
+
+class ResultCacheStats(object):
+    """ Counters of result cache hits and misses."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+result_cache_stats = ResultCacheStats()
+
+
+def get_cache(alias=None):
+    from django.core.cache import caches
+    if alias is None:
+        alias = getattr(settings, 'SPHINX_RESULT_CACHE', 'default')
+    return caches[alias]
+
+
+def _initial_generation():
+    # evicted counter restarts from value greater than previous ones
+    return int(time.time() * 1000000)
+
+
+def get_generation(index):
+    """ Returns current write generation of index."""
+    cache = get_cache()
+    key = GENERATION_KEY % index
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _initial_generation(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(index):
+    """ Invalidates cached and in-flight results for index."""
+    flights.forget(index)
+    cache = get_cache()
+    key = GENERATION_KEY % index
+    try:
+        cache.incr(key)
+    except ValueError:
+        # counter is missing in cache
+        cache.add(key, _initial_generation(), None)
+
+
+def get_results(cache, key):
+    """ Returns cached results and their expiration time.
+
+    :returns: (expires, results) tuple, None if results are not cached
+    """
+    return cache.get(key)
+
+
+def set_results(cache, key, results, ttl):
+    """ Stores results with their expiration time.
+
+    :returns: expiration timestamp, None for results cached forever
+    """
+    expires = None if ttl is None else time.time() + ttl
+    cache.set(key, (expires, results), ttl)
+    return expires
+
+
+def make_key(index, using, statements):
+    """ Returns cache key for results of statements executed for index."""
+    digest = hashlib.md5(repr((using, statements)).encode('utf-8'))
+    return RESULT_KEY % (index, get_generation(index), digest.hexdigest())
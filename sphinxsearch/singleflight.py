@@ -0,0 +1,97 @@
+# coding: utf-8
+""" Coalescing of identical concurrent searches in one process.
+
+When settings.SPHINX_SINGLEFLIGHT_TIMEOUT is set, threads executing same
+statements while another thread waits for searchd response don't send them
+again, but wait up to timeout seconds for results of in-flight query.
+Waiters timed out execute query themselves.
+"""
+import threading
+
+from django.conf import settings
+
+
+def get_timeout():
+    """ Returns max time to wait for in-flight query, None if disabled."""
+    return getattr(settings, 'SPHINX_SINGLEFLIGHT_TIMEOUT', None)
+
+
+class Flight(object):
+    """ Query executed by one thread and awaited by others."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Executes function once for concurrent calls with same key.
+
+    Keys are (index, ...) tuples, so forget(index) detaches in-flight
+    queries of index after write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.executed = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout=None):
+        """ Returns result of func(), shared with concurrent calls for key.
+
+        Exception raised by func() is re-raised in all waiting threads.
+
+        :param timeout: max time to wait for in-flight call before calling
+            func() in current thread
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.executed += 1
+        if leader:
+            try:
+                flight.result = func()
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                flight.done.set()
+            return flight.result
+
+        if not flight.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+                self.executed += 1
+            return func()
+        with self._lock:
+            self.shared += 1
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def forget(self, index):
+        """ Starts new query for next calls instead of waiting for queries of
+        index already in flight."""
+        with self._lock:
+            for key in [k for k in self._flights if k[0] == index]:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self.executed, 'shared': self.shared,
+                    'timeouts': self.timeouts}
+
+    def clear(self):
+        with self._lock:
+            self.executed = self.shared = self.timeouts = 0
+
+
+flights = SingleFlight()
@@ -3,15 +3,25 @@
 # $Id: $
 from collections import OrderedDict
 import functools
+from django.conf import settings
 from django.db import models
 from django.db.models import Count, BooleanField
 from django.db.models.base import ModelBase
 from django.db.models.expressions import Col, Func, BaseExpression
 from django.db.models.sql import Query
+from django.db.models.sql.constants import MULTI
 from django.db.models.sql.where import WhereNode, ExtraWhere
 from django.utils.datastructures import OrderedSet
 
 
+# count() strategies: COUNT(*) query, total_found from SHOW META, or
+# total_found for queries where it is exact
+COUNT_EXACT = 'exact'
+COUNT_META = 'meta'
+COUNT_AUTO = 'auto'
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_META, COUNT_AUTO)
+
+
 class SphinxCount(Count):
     """ Replaces Mysql-like COUNT('*') with COUNT(*) token."""
     template = '%(function)s(*)'
@@ -43,6 +53,23 @@ class SphinxExtraWhere(ExtraWhere):
         return " AND ".join(sqls), tuple(self.params or ())
 
 
+class SphinxExtraIn(ExtraWhere):
+    """ IN() condition formatted with compiler-specific syntax."""
+
+    def __init__(self, column, params, negated=False):
+        self.column = column
+        self.negated = negated
+        super(SphinxExtraIn, self).__init__([], params)
+
+    def as_sql(self, qn=None, connection=None):
+        template = getattr(qn, 'in_template', '(IN(%s, %s))')
+        placeholders = ', '.join(['%s'] * len(self.params))
+        sql = template % (self.column, placeholders)
+        if self.negated:
+            sql = 'NOT %s' % sql
+        return sql, tuple(self.params)
+
+
 class SphinxWhereNode(WhereNode):
 
     def make_atom(self, child, qn, connection):
@@ -87,9 +114,46 @@ class SphinxWhereNode(WhereNode):
         return sql, params
 
 
+class SphinxMeta(dict):
+    """ Parsed SHOW META result.
+
+    Contains raw values of all meta variables, i.e. "total", "total_found",
+    "time", "keyword[N]", "docs[N]", "hits[N]", and typed shortcuts for them.
+    """
+    statement = 'SHOW META'
+
+    @property
+    def total(self):
+        """ Number of matches returned to client."""
+        return int(self.get('total', 0))
+
+    @property
+    def total_found(self):
+        """ Total number of matches found in index."""
+        return int(self.get('total_found', 0))
+
+    @property
+    def time(self):
+        """ Query execution time in seconds."""
+        return float(self.get('time', 0))
+
+    @property
+    def keywords(self):
+        """ Per-keyword statistics list of (keyword, docs, hits) tuples."""
+        result = []
+        i = 0
+        while 'keyword[%d]' % i in self:
+            result.append((self['keyword[%d]' % i],
+                           int(self.get('docs[%d]' % i, 0)),
+                           int(self.get('hits[%d]' % i, 0))))
+            i += 1
+        return result
+
+
 class SphinxQuery(Query):
     _clonable = ('options', 'match', 'group_limit', 'group_order_by',
-                 'with_meta')
+                 'with_meta', 'facets', 'count_strategy', 'keyset_ordering',
+                 'result_cache')
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault('where', SphinxWhereNode)
@@ -119,10 +183,68 @@ class SphinxQuery(Query):
             else:
                 self.match[field].add(expression)
 
+    def set_fetched_results(self, results):
+        """ Stores FACET and SHOW META results fetched for query.
+
+        :param results: iterator over result sets of multi-statement query,
+            None if query has empty result and was not executed.
+        :returns: rows fetched for query itself
+        :rtype: list
+        """
+        def fetch():
+            return next(results) if results is not None else []
+
+        rows = fetch()
+        facets = getattr(self, 'facets', None)
+        if facets:
+            # each FACET result set contains (value, count(*)) rows
+            self.fetched_facets = OrderedDict(
+                (name, [tuple(row[:2]) for row in fetch()])
+                for name, _ in facets)
+        if getattr(self, 'with_meta', False):
+            self.fetched_meta = SphinxMeta(fetch())
+        return rows
+
     def get_count(self, using):
         """
         Performs a COUNT() query using the current filter constraints.
+
+        Depending on count strategy, number of matches is taken from
+        SHOW META total_found instead.
         """
+        strategy = (getattr(self, 'count_strategy', None) or
+                    getattr(settings, 'SPHINX_COUNT_STRATEGY', COUNT_EXACT))
+        if strategy == COUNT_META or (strategy == COUNT_AUTO and
+                                      self.group_by is None and
+                                      not self.distinct):
+            return self.get_meta_count(using)
+        return self.get_exact_count(using)
+
+    def get_meta_count(self, using):
+        """ Returns number of matches using SHOW META total_found.
+
+        Query is executed with LIMIT 1 and without ranking, so searchd only
+        counts matches without sorting them. total_found is approximate for
+        grouped queries.
+        """
+        obj = self.clone()
+        obj.clear_ordering(True)
+        obj.facets = None
+        obj.with_meta = True
+        obj.options = dict(getattr(obj, 'options', None) or {},
+                           ranker='none')
+        low_mark, high_mark = obj.low_mark, obj.high_mark
+        obj.clear_limits()
+        obj.set_limits(0, 1)
+        list(obj.get_compiler(using).execute_sql(MULTI))
+
+        number = max(obj.fetched_meta.total_found - low_mark, 0)
+        if high_mark is not None:
+            number = min(number, high_mark - low_mark)
+        return number
+
+    def get_exact_count(self, using):
+        """ Performs a COUNT(*) query."""
         obj = self.clone()
         obj.add_annotation(SphinxCount('*'), alias='__count', is_summary=True)
         number = obj.get_aggregation(using, ['__count'])['__count']
@@ -1,10 +1,17 @@
 # coding: utf-8
 
 # $Id: $
+import base64
+import hashlib
+import json
 import re
+import struct
 
 from django.utils import six
 
+# characters escaped in SQL string literals
+ESCAPED_CHARS = (b'\\', b"'", b'"', b'\0', b'\n', b'\r', b'\x1a')
+
 
 def sphinx_escape(value):
     """ Escapes SphinxQL search expressions. """
@@ -15,3 +22,55 @@ def sphinx_escape(value):
     value = re.sub(r"([=<>()|!@~&/^$\-\'\"\\])", r'\\\\\\\1', value)
     value = re.sub(r'\b(SENTENCE|PARAGRAPH)\b', r'\\\\\\\1', value)
     return value
+
+
+def to_float32(value):
+    """ Rounds float to single precision used by searchd for float
+    attributes."""
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
+def content_hash(values):
+    """ Returns positive 60-bit hash of document field values, stable between
+    processes and python versions."""
+    data = json.dumps(list(values), separators=(',', ':'), sort_keys=True,
+                      default=six.text_type)
+    return int(hashlib.md5(data.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def encode_cursor(values):
+    """ Encodes list of sort key values to opaque pagination cursor."""
+    data = json.dumps(list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes pagination cursor to list of sort key values."""
+    try:
+        if isinstance(cursor, six.text_type):
+            cursor = cursor.encode('ascii')
+        values = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def literal_size(value):
+    """ Returns upper bound for size of value escaped as SQL literal."""
+    if value is None or isinstance(value, (bool,) + six.integer_types):
+        return 21
+    if isinstance(value, float):
+        return 26
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(literal_size(v) + 1 for v in value)
+    if not isinstance(value, six.binary_type):
+        value = six.text_type(value).encode('utf-8')
+    # quotes, _binary prefix and escaped characters
+    return 10 + len(value) + sum(value.count(c) for c in ESCAPED_CHARS)
+
+
+def statement_size(sql, params):
+    """ Returns upper bound for size of statement with params substituted."""
+    return len(sql) + 2 + sum(map(literal_size, params))
@@ -78,6 +78,14 @@ class ForcedPKModel(FieldMixin, spx_models.SphinxModel):
     id = models.BigIntegerField(primary_key=True)
 
 
+class ContentHashModel(FieldMixin, spx_models.SphinxModel):
+
+    class Meta:
+        db_table = 'testapp_testmodel'
+
+    content_hash_field = 'attr_bigint'
+
+
 class ModelWithAllDbColumnFields(spx_models.SphinxModel):
     class Meta:
         db_table = 'testapp_testmodel_aliased'
@@ -1,20 +1,41 @@
 # coding: utf-8
 
 # $Id: $
+import os
 import sys
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
 
+import django
+import six
 from django.conf import settings
-from django.db import connections
+from django.core.management import call_command, CommandError
+from django.core.paginator import EmptyPage, PageNotAnInteger
+from django.core.signals import request_finished
+from django.db import connections, transaction
 from django.db.models import Sum, Q
 from django.db.utils import ProgrammingError
-from django.test import TransactionTestCase
-from django.test.utils import CaptureQueriesContext
-from unittest import expectedFailure
-
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from MySQLdb.constants import CLIENT
+from unittest import expectedFailure, skipIf
+
+from sphinxsearch import aliases, batch_writes
+from sphinxsearch.result_cache import result_cache_stats
+from sphinxsearch.backend.sphinx.cache import statement_cache
+from sphinxsearch.buffer import enable_write_buffer, disable_write_buffer
+from sphinxsearch.checker import IndexChecker
+from sphinxsearch.indexer import SphinxIndexer
+from sphinxsearch.mmap_cache import MmapCache
+from sphinxsearch.models import batch, content_hash_stats
+from sphinxsearch.paginator import SphinxPaginator
+from sphinxsearch.refresh import enable_refresh_ahead, disable_refresh_ahead
 from sphinxsearch.utils import sphinx_escape
 from testapp import models
 from sphinxsearch.routers import SphinxRouter
+from sphinxsearch.singleflight import SingleFlight, flights
 
 
 class SphinxModelTestCaseBase(TransactionTestCase):
@@ -28,7 +49,8 @@ class SphinxModelTestCaseBase(TransactionTestCase):
 
     def truncate_model(self):
         c = connections[settings.SPHINX_DATABASE_NAME].cursor()
-        c.execute("TRUNCATE RTINDEX %s" % self.model._meta.db_table)
+        c.execute("TRUNCATE RTINDEX %s" %
+                  aliases.resolve(self.model._meta.db_table))
         c.close()
 
     def setUp(self):
@@ -132,11 +154,76 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
             self.assertObjectEqualsToDefaults(other)
 
     def testShowMeta(self):
+        queries = len(self.spx_queries.captured_queries)
         qs = self.model.objects.all().with_meta()
         self.assertEqual(len(list(qs)), 1)
         self.assertTrue(hasattr(qs, 'meta'))
         self.assertIsInstance(qs.meta, dict)
-        self.assertDictEqual(qs.meta, {'total': '1'})
+        self.assertEqual(qs.meta['total'], '1')
+        self.assertEqual(qs.meta.total, 1)
+        self.assertEqual(qs.meta.total_found, 1)
+        self.assertIn('time', qs.meta)
+        # SHOW META is sent in same round trip with SELECT
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+
+    def testShowMetaNewConnection(self):
+        # multi-statement flags are set when connection is opened
+        connections[settings.SPHINX_DATABASE_NAME].close()
+        qs = self.model.objects.all().with_meta()
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(qs.meta.total_found, 1)
+
+    def testShowMetaKeywords(self):
+        qs = self.model.objects.match('hello').with_meta()
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(qs.meta.keywords, [('hello', 1, 1)])
+
+    def testBatchShowMeta(self):
+        self.create_multiple_models()
+        hits = self.model.objects.all()[:2].with_meta()
+        other = self.model.objects.all().with_meta()
+        batch(hits, other)
+        self.assertEqual(hits.meta.total, 2)
+        self.assertEqual(hits.meta.total_found, 11)
+        self.assertEqual(other.meta.total, 11)
+
+    def testFacet(self):
+        queries = len(self.spx_queries.captured_queries)
+        qs = self.model.objects.all().facet('attr_uint', 'attr_multi')
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(list(qs.facets.keys()), ['attr_uint', 'attr_multi'])
+        self.assertEqual(qs.facets['attr_uint'], [(100500, 1)])
+        self.assertSetEqual(set(qs.facets['attr_multi']),
+                            {(1, 1), (2, 1), (3, 1)})
+        # FACET result sets are fetched in same round trip with SELECT
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+
+    def testFacetOrderByLimit(self):
+        for i in range(2):
+            self.model.objects.create(id=self.newid(), attr_uint=10)
+        qs = self.model.objects.all().facet('attr_uint', order_by='-count',
+                                            limit=1)
+        list(qs)
+        self.assertEqual(qs.facets['attr_uint'], [(10, 2)])
+
+    def testFacetJsonPath(self):
+        qs = self.model.objects.all().facet('attr_json.json').with_meta()
+        list(qs)
+        self.assertEqual([v for v, _ in qs.facets['attr_json.json']],
+                         ['test'])
+        self.assertEqual(qs.meta.total, 1)
+
+    def testFacetCount(self):
+        qs = self.model.objects.all().facet('attr_uint')
+        self.assertEqual(qs.count(), 1)
+        self.assertTrue(qs.exists())
+
+    def testBatchFacet(self):
+        hits = self.model.objects.all().facet('attr_uint')
+        other = self.model.objects.all()
+        batch(hits, other)
+        self.assertEqual(hits.facets['attr_uint'], [(100500, 1)])
+        self.assertEqual(len(other), 1)
 
     def testExcludeByAttrs(self):
         exclude = ['attr_multi', 'attr_multi_64', 'attr_json', 'sphinx_field',
@@ -216,6 +303,69 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
         other = self.reload_object(self.obj)
         self.assertFalse(other.attr_bool)
 
+    def testBulkCreate(self):
+        queries = len(self.spx_queries.captured_queries)
+        objs = [self.model(id=self.newid(), attr_uint=i,
+                           attr_string='string %d' % i) for i in range(10)]
+        self.model.objects.bulk_create(objs)
+        # all rows are inserted with one statement
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+        qs = self.model.objects.filter(attr_uint__lt=10).order_by('attr_uint')
+        self.assertListEqual([o.attr_string for o in qs],
+                             ['string %d' % i for i in range(10)])
+
+    def testBulkReplace(self):
+        objs = [self.model(id=self.newid(), attr_uint=i) for i in range(10)]
+        self.model.objects.bulk_create(objs)
+        for obj in objs:
+            obj.attr_string = "x" * 100
+        connection = connections[settings.SPHINX_DATABASE_NAME]
+        # small packet size forces splitting into several statements
+        connection.max_packet_size = 4096 + 1000
+        queries = len(self.spx_queries.captured_queries)
+        try:
+            self.model.objects.bulk_replace(objs + [self.obj])
+        finally:
+            del connection.max_packet_size
+        self.assertGreater(len(self.spx_queries.captured_queries),
+                           queries + 1)
+        self.assertEqual(self.model.objects.count(), 11)
+        qs = self.model.objects.filter(id__in=[o.id for o in objs])
+        self.assertListEqual([o.attr_string for o in qs], ["x" * 100] * 10)
+
+    def testBulkReplaceDeferred(self):
+        obj = self.reload_object(self.obj)
+        with self.assertRaises(ValueError):
+            self.model.objects.bulk_replace([obj])
+        self.assertEqual(self.model.objects.match('hello').count(), 1)
+
+    def testReplaceUpdate(self):
+        self.create_multiple_models()
+        qs = self.model.objects.filter(attr_uint__lt=5)
+        count = qs.update(attr_string='updated', sphinx_field='replaced',
+                          other_field='')
+        self.assertEqual(count, 5)
+        qs = self.model.objects.filter(attr_uint__lt=10).order_by('attr_uint')
+        self.assertListEqual([(o.attr_uint, o.attr_string) for o in qs],
+                             [(i, 'updated' if i < 5 else '')
+                              for i in range(10)])
+        self.assertEqual(self.model.objects.match('replaced').count(), 5)
+        other = self.reload_object(self.obj)
+        self.assertObjectEqualsToDefaults(other)
+
+    def testReplaceUpdateRequiresTextFields(self):
+        qs = self.model.objects.all()
+        self.assertRaises(ValueError, qs.replace_update,
+                          {'attr_string': 'updated'})
+
+    def testUpdateWithoutTextFieldsNotReplaced(self):
+        qs = self.model.objects.filter(pk=self.obj.pk)
+        queries = len(self.spx_queries.captured_queries)
+        qs.update(attr_string='updated')
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+        self.assertFalse(self.spx_queries.captured_queries[-1]['sql']
+                         .startswith('SELECT'))
+
     def testDelete(self):
         if self.no_string_compare:
             self.skipTest("searchd version is too low")
@@ -227,11 +377,33 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
         expected = self.create_multiple_models()
         delete_ids = expected[3:7]
         self.model.objects.filter(id__in=delete_ids).delete()
+        delete_sql = self.spx_queries.captured_queries[-1]['sql']
+        self.assertRegexpMatches(delete_sql, r'WHERE \w+ IN \(')
         qs = self.model.objects.filter(id__in=delete_ids)
         self.assertEqual(len(qs), 0)
         qs = self.model.objects.all().values_list('id', flat=True)
         self.assertListEqual(list(qs), expected[:3] + expected[7:])
 
+    def testBulkDelete(self):
+        expected = self.create_multiple_models()
+        delete_ids = expected[2:5] + expected[6:9]
+        progress = []
+        deleted = self.model.objects.all().bulk_delete(
+            ids=delete_ids, batch_size=3,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual(deleted, 6)
+        self.assertListEqual(progress, [(3, 3), (6, 6)])
+        delete_sql = self.spx_queries.captured_queries[-1]['sql']
+        self.assertIn('BETWEEN', delete_sql)
+        qs = self.model.objects.all().values_list('id', flat=True)
+        self.assertListEqual(list(qs), expected[:2] + expected[5:6] +
+                             expected[9:])
+
+    def testBulkDeleteMatched(self):
+        self.create_multiple_models()
+        qs = self.model.objects.filter(attr_uint__lt=5)
+        self.assertEqual(qs.bulk_delete(batch_size=2), 5)
+        self.assertEqual(self.model.objects.count(), 6)
 
     def testDjangoSearch(self):
         other = self.model.objects.filter(sphinx_field__search="hello")[0]
@@ -287,6 +459,31 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
         qs = list(self.model.objects.all()[2:4])
         self.assertEqual([q.id for q in qs], expected[2:4])
 
+    def testBatch(self):
+        expected = self.create_multiple_models()
+        queries = len(self.spx_queries.captured_queries)
+
+        hits = self.model.objects.all()[2:4]
+        ids = self.model.objects.values_list('id', flat=True)
+        empty = self.model.objects.match("doesnotexistinindex")
+        result = batch(hits, ids, empty)
+
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+        self.assertEqual(result, [hits, ids, empty])
+        self.assertEqual([q.id for q in hits], expected[2:4])
+        self.assertListEqual(list(ids), expected)
+        self.assertEqual(len(empty), 0)
+        # querysets are evaluated, no queries performed
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+
+    def testBatchWith(self):
+        qs = self.model.objects.filter(attr_uint=self.defaults['attr_uint'])
+        other = self.model.objects.exclude(attr_uint=self.defaults['attr_uint'])
+        qs.batch_with(other)
+        self.assertIsNotNone(qs._result_cache)
+        self.assertObjectEqualsToDefaults(qs[0])
+        self.assertEqual(len(other), 0)
+
     def create_multiple_models(self):
         expected = [self.obj.id]
         for i in range(10):
@@ -379,6 +576,22 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
                               group_order_by='-attr_float'))
         self.assertSetEqual({o.id for o in qs}, {self.obj.id, m2.id, m3.id})
 
+    def testGroupByJsonPath(self):
+        self.model.objects.create(id=self.newid(),
+                                  attr_json={"json": "test"})
+        m2 = self.model.objects.create(id=self.newid(),
+                                       attr_json={"json": "other"})
+        qs = self.model.objects.defer('attr_json', 'attr_multi',
+                                      'attr_multi_64')
+        qs = list(qs.group_by('attr_json.json'))
+        self.assertEqual(len(qs), 2)
+        self.assertIn(m2.id, {o.id for o in qs})
+
+    def testLimitOffsetSyntax(self):
+        sql, params = self.model.objects.all()[2:4].query.sql_with_params()
+        self.assertTrue(sql.endswith('LIMIT %s, %s'), msg=sql)
+        self.assertEqual(params[-2:], (2, 2))
+
     def testAggregation(self):
         s = self.model.objects.aggregate(Sum('attr_uint'))
         self.assertEqual(s['attr_uint__sum'], self.defaults['attr_uint'])
@@ -398,6 +611,82 @@ class SphinxModelTestCase(SphinxModelTestCaseBase):
         r = self.model.objects.filter(attr_uint__gte=-1).count()
         self.assertEqual(r, 11)
 
+    def testCountStrategy(self):
+        self.create_multiple_models()
+        qs = self.model.objects.filter(attr_uint__gte=-1)
+        self.assertEqual(qs.count_strategy('exact').count(), 11)
+        self.assertIn('COUNT(*)', self.spx_queries.captured_queries[-1]['sql'])
+        meta = qs.count_strategy('meta')
+        self.assertEqual(meta.count(), 11)
+        self.assertIn('SHOW META',
+                      self.spx_queries.captured_queries[-1]['sql'])
+        self.assertEqual(meta[5:].count(), 6)
+        self.assertEqual(meta[2:4].count(), 2)
+        self.assertRaises(ValueError, qs.count_strategy, 'unknown')
+
+    def testCountStrategyDefault(self):
+        self.create_multiple_models()
+        qs = self.model.objects.filter(attr_uint__gte=-1)
+        self.assertEqual(qs.count(), 11)
+        self.assertIn('COUNT(*)', self.spx_queries.captured_queries[-1]['sql'])
+        with self.settings(SPHINX_COUNT_STRATEGY='auto'):
+            self.assertEqual(qs.count(), 11)
+            self.assertIn('SHOW META',
+                          self.spx_queries.captured_queries[-1]['sql'])
+            # grouped queries count exactly
+            grouped = qs.group_by('attr_uint')
+            self.assertEqual(grouped.count(), len(list(grouped)))
+
+    def testSearchAfter(self):
+        self.create_multiple_models()
+        qs = self.model.objects.order_by('-attr_uint')
+        expected = [o.id for o in qs.order_by('-attr_uint', 'id')]
+        result = []
+        cursor = None
+        for _ in range(4):
+            page = qs.search_after(cursor)[:4]
+            result.extend(o.id for o in page)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertIsNone(cursor)
+        self.assertEqual(result, expected)
+        self.assertRaises(ValueError, qs.search_after, 'invalid')
+
+    def testSearchAfterFloat(self):
+        # values not representable in single precision with ties on pages
+        # boundaries
+        for i in range(6):
+            self.model.objects.create(id=self.newid(), attr_json={},
+                                      attr_float=0.1 * (i // 3 + 1),
+                                      attr_timestamp=self.now)
+        qs = self.model.objects.order_by('attr_float')
+        expected = [o.id for o in qs.order_by('attr_float', 'id')]
+        result = []
+        cursor = None
+        while True:
+            page = qs.search_after(cursor)[:2]
+            result.extend(o.id for o in page)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(result, expected)
+
+    def testSearchAfterWeight(self):
+        qs = self.model.objects.match('hello').search_after()[:1]
+        self.assertEqual(len(qs), 1)
+        page = self.model.objects.match('hello').search_after(qs.next_cursor)
+        self.assertEqual(len(page), 0)
+
+    def testIterAll(self):
+        expected = sorted(self.create_multiple_models())
+        qs = self.model.objects.all()
+        self.assertEqual([o.id for o in qs.iter_all(chunk_size=3)], expected)
+        result = [o.id for o in qs.iter_all(chunk_size=4, prefetch=True)]
+        self.assertEqual(result, expected)
+        qs = qs.filter(attr_uint__lt=5)
+        self.assertEqual(len(list(qs.iter_all(chunk_size=2))), 5)
+
     def testCastToChar(self):
         if self.no_string_compare:
             self.skipTest("string compare not supported by server")
@@ -549,6 +838,743 @@ class TestSphinxRouter(SphinxModelTestCaseBase):
             models.DefaultDjangoModel()))
 
 
+class StatementCacheTestCase(SphinxModelTestCaseBase):
+    """ Checks compiled statements caching."""
+
+    def setUp(self):
+        super(StatementCacheTestCase, self).setUp()
+        statement_cache.clear()
+
+    def tearDown(self):
+        statement_cache._max_size = None
+        super(StatementCacheTestCase, self).tearDown()
+
+    def get_queryset(self, attr_uint, text):
+        return self.model.objects.match(text).filter(
+            attr_uint=attr_uint).options(max_matches=10)
+
+    def testRepeatedShapeHitsCache(self):
+        qs = list(self.get_queryset(self.defaults['attr_uint'], 'hello'))
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(statement_cache.stats()['misses'], 1)
+
+        qs = list(self.get_queryset(self.defaults['attr_uint'], 'hello'))
+        self.assertEqual(len(qs), 1)
+        self.assertObjectEqualsToDefaults(qs[0])
+
+        # another filter values and match text use same SQL template
+        qs = list(self.get_queryset(0, 'hello'))
+        self.assertEqual(len(qs), 0)
+        qs = list(self.get_queryset(self.defaults['attr_uint'], 'nothing'))
+        self.assertEqual(len(qs), 0)
+
+        stats = statement_cache.stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['size'], 1)
+
+    def testCachedSQLEqualsCompiled(self):
+        expected = str(self.get_queryset(1, 'hello').query)
+        str(self.get_queryset(2, 'world').query)
+        self.assertEqual(str(self.get_queryset(1, 'hello').query), expected)
+        self.assertEqual(statement_cache.stats()['hits'], 2)
+
+    def testCacheDisabled(self):
+        statement_cache._max_size = 0
+        list(self.get_queryset(self.defaults['attr_uint'], 'hello'))
+        qs = list(self.get_queryset(self.defaults['attr_uint'], 'hello'))
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(statement_cache.stats()['hits'], 0)
+        self.assertEqual(len(statement_cache), 0)
+
+
+class SphinxPaginatorTestCase(SphinxModelTestCaseBase):
+    """ Checks pagination with total_found and max_matches window."""
+
+    def setUp(self):
+        super(SphinxPaginatorTestCase, self).setUp()
+        for i in range(10):
+            self.model.objects.create(id=self.newid(), attr_uint=i)
+        self.qs = self.model.objects.order_by('id')
+
+    def testPageInOneQuery(self):
+        queries = len(self.spx_queries.captured_queries)
+        paginator = SphinxPaginator(self.qs, 4)
+        page = paginator.page(2)
+        self.assertEqual(len(page), 4)
+        self.assertEqual(paginator.count, 11)
+        self.assertEqual(paginator.num_pages, 3)
+        self.assertTrue(page.has_next())
+        self.assertEqual(len(self.spx_queries.captured_queries), queries + 1)
+
+    def testOrphans(self):
+        paginator = SphinxPaginator(self.qs, 4, orphans=3)
+        self.assertEqual(len(paginator.page(2)), 7)
+        self.assertEqual(paginator.num_pages, 2)
+
+    def testMaxMatchesRaised(self):
+        paginator = SphinxPaginator(self.qs, 4, max_matches=5,
+                                    max_matches_limit=8)
+        page = paginator.page(2)
+        self.assertEqual(len(page), 4)
+        self.assertIn('max_matches=8',
+                      self.spx_queries.captured_queries[-1]['sql'])
+        self.assertEqual(paginator.count, 8)
+        self.assertEqual(paginator.total_found, 11)
+        self.assertFalse(page.has_next())
+        self.assertRaises(EmptyPage, paginator.page, 3)
+
+    def testEmptyPage(self):
+        paginator = SphinxPaginator(self.qs, 4)
+        self.assertRaises(EmptyPage, paginator.page, 4)
+        self.assertRaises(PageNotAnInteger, paginator.page, 'x')
+
+
+class WriteBufferTestCase(SphinxModelTestCaseBase):
+    """ Checks buffered save() and delete() calls."""
+
+    def setUp(self):
+        super(WriteBufferTestCase, self).setUp()
+        # background flushes are disabled, buffer is flushed explicitly
+        self.buffer = enable_write_buffer(settings.SPHINX_DATABASE_NAME,
+                                          max_size=1000, flush_interval=3600)
+
+    def tearDown(self):
+        disable_write_buffer(settings.SPHINX_DATABASE_NAME)
+        super(WriteBufferTestCase, self).tearDown()
+
+    def testSaveCoalesced(self):
+        self.obj.attr_uint = 1
+        self.obj.save()
+        self.obj.attr_uint = 2
+        self.obj.save()
+        self.assertEqual(len(self.buffer), 1)
+        self.assertEqual(self.reload_object(self.obj).attr_uint,
+                         self.defaults['attr_uint'])
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.reload_object(self.obj).attr_uint, 2)
+
+    def testDeleteSupersedesSave(self):
+        obj = self.model(id=self.newid(), attr_uint=1)
+        obj.save()
+        self.obj.save()
+        self.obj.delete()
+        self.assertEqual(len(self.buffer), 2)
+
+        self.buffer.flush()
+        self.assertEqual(list(self.model.objects.values_list('id', flat=True)),
+                         [obj.id])
+
+    def testDeleteResult(self):
+        self.assertEqual(self.obj.delete(), (1, {'testapp.TestModel': 1}))
+
+    def testLoadedDocumentSavedDirectly(self):
+        self.obj.attr_uint = 1
+        self.obj.save()
+        obj = self.reload_object(self.obj)
+        obj.attr_uint = 2
+        obj.save()
+        # pending write is flushed before direct update
+        self.assertEqual(len(self.buffer), 0)
+
+        other = self.model.objects.match('hello').get(pk=self.obj.pk)
+        self.assertEqual(other.attr_uint, 2)
+        self.assertEqual(other.attr_string, self.defaults['attr_string'])
+
+    def testFailedFlushRequeued(self):
+        def fail(*args, **kwargs):
+            raise ProgrammingError()
+
+        self.obj.attr_uint = 1
+        self.obj.save()
+        self.buffer._write = fail
+        with self.assertRaises(ProgrammingError):
+            self.buffer.flush()
+        del self.buffer._write
+        self.assertEqual(len(self.buffer), 1)
+
+        self.buffer.flush()
+        self.assertEqual(self.reload_object(self.obj).attr_uint, 1)
+
+    def testFailedWritesDropped(self):
+        def fail(*args, **kwargs):
+            raise ProgrammingError()
+
+        self.obj.save()
+        self.buffer._write = fail
+        for _ in range(self.buffer.max_attempts):
+            with self.assertRaises(ProgrammingError):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 0)
+
+
+class BatchWritesTestCase(SphinxModelTestCaseBase):
+    """ Checks writes batched with RT transactions."""
+
+    def testWritesCommittedOnExit(self):
+        using = settings.SPHINX_DATABASE_NAME
+        with batch_writes(using):
+            objs = [self.model(id=self.newid(), attr_uint=i)
+                    for i in range(3)]
+            for obj in objs:
+                obj.save()
+            self.obj.delete()
+            self.assertEqual(self.model.objects.count(), 1)
+
+        ids = self.model.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(ids), [obj.id for obj in objs])
+
+    def testWritesDiscardedOnError(self):
+        using = settings.SPHINX_DATABASE_NAME
+        with self.assertRaises(ValueError):
+            with batch_writes(using):
+                self.model(id=self.newid()).save()
+                raise ValueError()
+        self.assertEqual(self.model.objects.count(), 1)
+
+    def testLoadedDocumentSavedDirectly(self):
+        using = settings.SPHINX_DATABASE_NAME
+        with batch_writes(using) as batch:
+            obj = self.reload_object(self.obj)
+            obj.attr_uint = 2
+            obj.save()
+            self.assertEqual(len(batch), 0)
+            with self.assertRaises(ValueError):
+                batch.replace(obj)
+
+        other = self.model.objects.match('hello').get(pk=self.obj.pk)
+        self.assertEqual(other.attr_uint, 2)
+        self.assertEqual(other.attr_string, self.defaults['attr_string'])
+
+
+class TestModelIndexer(SphinxIndexer):
+    # full-text fields are not fetched from sphinx source model
+    model = models.TestModel
+    index = models.ModelWithAllDbColumnFields
+    fields = ('attr_uint', 'attr_string')
+
+    def should_index(self, obj):
+        return obj.attr_bool
+
+
+class SphinxIndexerTestCase(SphinxModelTestCaseBase):
+    """ Checks mirroring of source model to another index."""
+
+    def setUp(self):
+        super(SphinxIndexerTestCase, self).setUp()
+        self.index = models.ModelWithAllDbColumnFields
+        c = connections[settings.SPHINX_DATABASE_NAME].cursor()
+        c.execute("TRUNCATE RTINDEX %s" % self.index._meta.db_table)
+        c.close()
+        self.indexer = TestModelIndexer()
+        self.indexer.connect()
+
+    def tearDown(self):
+        self.indexer.disconnect()
+        super(SphinxIndexerTestCase, self).tearDown()
+
+    def testSaveIndexed(self):
+        self.obj.attr_uint = 1
+        self.obj.save()
+        doc = self.index.objects.get(pk=self.obj.pk)
+        self.assertEqual(doc.attr_uint, 1)
+        self.assertEqual(doc.attr_string, self.defaults['attr_string'])
+
+        self.obj.attr_bool = False
+        self.obj.save()
+        self.assertEqual(self.index.objects.count(), 0)
+
+    def testDeferredFieldsNotIndexed(self):
+        self.indexer.fields += ('sphinx_field',)
+        with self.assertRaises(ValueError):
+            self.indexer.update([self.obj.pk])
+        self.assertEqual(self.index.objects.count(), 0)
+
+    @skipIf(django.VERSION < (1, 9), "on_commit() requires Django>=1.9")
+    def testRolledBackNotIndexed(self):
+        using = settings.SPHINX_DATABASE_NAME
+        with self.assertRaises(ValueError):
+            with transaction.atomic(using=using, savepoint=False):
+                self.model.objects.create(id=self.newid(), attr_bool=True)
+                raise ValueError()
+        self.assertEqual(self.index.objects.count(), 0)
+
+    def testRequestFinishedErrorLogged(self):
+        def fail(pks):
+            raise ProgrammingError()
+
+        self.indexer._request_started()
+        self.obj.save()
+        self.indexer.update = fail
+        # error doesn't propagate from signal handler
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.indexer._batching, 0)
+        self.assertEqual(self.index.objects.count(), 0)
+
+    def testBatchBuiltWithOneQuery(self):
+        table = '`%s`' % self.model._meta.db_table
+        with self.indexer.batch():
+            objs = [self.model.objects.create(id=self.newid(), attr_uint=i,
+                                              attr_bool=True)
+                    for i in range(3)]
+            objs[0].delete()
+            self.assertEqual(self.index.objects.count(), 0)
+        selects = [q for q in self.spx_queries.captured_queries
+                   if q['sql'].startswith('SELECT') and table in q['sql']]
+        self.assertEqual(len(selects), 1)
+
+        ids = self.index.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(ids), [objs[1].id, objs[2].id])
+
+    def testIndexUpdated(self):
+        self.indexer.disconnect()
+        self.indexer.updated_field = 'attr_timestamp'
+        self.model.objects.create(id=self.newid(), attr_bool=True,
+                                  attr_timestamp=self.now - timedelta(days=1))
+        new = self.model.objects.create(
+            id=self.newid(), attr_bool=True,
+            attr_timestamp=self.now + timedelta(seconds=1))
+
+        written, watermark = self.indexer.index_updated(
+            self.now - timedelta(hours=1))
+        self.assertEqual(written, 2)
+        ids = self.index.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(ids), [self.obj.id, new.id])
+
+        # row modified at watermark time is committed after previous run
+        late = self.model.objects.create(id=self.newid(), attr_bool=True,
+                                         attr_timestamp=watermark)
+        self.assertEqual(self.indexer.index_updated(watermark),
+                         (2, watermark))
+        self.assertTrue(self.index.objects.filter(pk=late.pk).exists())
+
+    def testCheckerFindsDrift(self):
+        self.indexer.update([self.obj.pk])
+        objs = [self.model.objects.create(id=self.newid(), attr_uint=i,
+                                          attr_bool=True)
+                for i in range(5)]
+        self.indexer.disconnect()
+        self.index.objects.get(pk=objs[1].pk).delete()
+        self.index.objects.filter(pk=objs[3].pk).update(attr_uint=100)
+        extra = self.index.objects.create(id=self.newid())
+        checker = IndexChecker(self.indexer, check_fields=('attr_uint',),
+                               parts=2, leaf_size=2)
+
+        ids = [pk for chunk in checker.find_differences() for pk in chunk]
+        self.assertEqual(ids, [objs[1].pk, objs[3].pk, extra.pk])
+
+        checker.repair(ids)
+        self.assertEqual(list(checker.find_differences()), [])
+
+    def testCheckerFindsSwappedValues(self):
+        self.indexer.update([self.obj.pk])
+        objs = [self.model.objects.create(id=self.newid(), attr_uint=i,
+                                          attr_bool=True)
+                for i in range(4)]
+        self.indexer.disconnect()
+        self.index.objects.filter(pk=objs[0].pk).update(attr_uint=1)
+        self.index.objects.filter(pk=objs[1].pk).update(attr_uint=0)
+        objs[2].attr_string = 'changed'
+        objs[2].save()
+        checker = IndexChecker(self.indexer,
+                               check_fields=('attr_uint', 'attr_string'),
+                               parts=2, leaf_size=1)
+
+        ids = [pk for chunk in checker.find_differences() for pk in chunk]
+        self.assertEqual(ids, [objs[0].pk, objs[1].pk, objs[2].pk])
+
+    def testReindexCommand(self):
+        self.indexer.disconnect()
+        objs = [self.model.objects.create(id=self.newid(), attr_uint=i,
+                                          attr_bool=bool(i))
+                for i in range(3)]
+        out = six.StringIO()
+        call_command('sphinx_reindex', 'testapp.tests.TestModelIndexer',
+                     range_size=2, stdout=out)
+        self.assertIn('Indexed 3 documents', out.getvalue())
+
+        ids = self.index.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(ids), [self.obj.id, objs[1].id, objs[2].id])
+
+
+@override_settings(SPHINX_INDEX_ALIASES={
+    'testapp_testmodel': ('testapp_testmodel', 'testapp_testmodel_green')})
+class BlueGreenIndexTestCase(SphinxModelTestCaseBase):
+    """ Checks switching readers between blue/green indexes."""
+    alias = 'testapp_testmodel'
+    shadow = 'testapp_testmodel_green'
+
+    def setUp(self):
+        super(BlueGreenIndexTestCase, self).setUp()
+        with aliases.using_index(self.alias, self.shadow):
+            self.truncate_model()
+
+    def tearDown(self):
+        if aliases.get_active(self.alias, refresh=True) != self.alias:
+            aliases.swap(self.alias, self.alias)
+        super(BlueGreenIndexTestCase, self).tearDown()
+
+    def testShadowNotVisibleUntilSwap(self):
+        with aliases.using_index(self.alias, self.shadow):
+            other = self.model.objects.create(id=self.newid())
+        ids = self.model.objects.values_list('id', flat=True)
+        self.assertEqual(list(ids), [self.obj.id])
+
+        self.assertEqual(aliases.swap(self.alias), self.alias)
+        ids = self.model.objects.values_list('id', flat=True)
+        self.assertEqual(list(ids), [other.id])
+
+        aliases.rollback(self.alias)
+        ids = self.model.objects.values_list('id', flat=True)
+        self.assertEqual(list(ids), [self.obj.id])
+
+    def testSwapCommandRefusesEmptyIndex(self):
+        with self.assertRaises(CommandError):
+            call_command('sphinx_swap', self.alias, stdout=six.StringIO())
+        self.assertEqual(aliases.get_active(self.alias), self.alias)
+
+
+class DirtyFieldsTestCase(SphinxModelTestCaseBase):
+    """ Checks saving only changed fields of loaded documents."""
+
+    def last_sql(self):
+        return self.spx_queries.captured_queries[-1]['sql']
+
+    def testFixedWidthFieldsUpdatedInPlace(self):
+        obj = self.reload_object(self.obj)
+        self.assertEqual(obj.get_dirty_fields(), [])
+        obj.attr_uint = 1
+        obj.attr_multi.append(4)
+        self.assertEqual(obj.get_dirty_fields(), ['attr_uint', 'attr_multi'])
+
+        obj.save()
+        self.assertTrue(self.last_sql().startswith('UPDATE'))
+        self.assertNotIn('attr_string', self.last_sql())
+        other = self.reload_object(obj)
+        self.assertEqual(other.attr_uint, 1)
+        self.assertEqual(other.attr_multi, [1, 2, 3, 4])
+        self.assertEqual(other.attr_string, self.defaults['attr_string'])
+
+    def testSnapshotTakenOnAssignment(self):
+        obj = self.reload_object(self.obj)
+        self.assertNotIn('_loaded_values', obj.__dict__)
+        obj.attr_multi = obj.attr_multi + [4]
+        self.assertIn('_loaded_values', obj.__dict__)
+        self.assertEqual(obj.get_dirty_fields(), ['attr_multi'])
+
+    def testStringFieldReplacesDocument(self):
+        obj = self.reload_object(self.obj)
+        obj.attr_uint = 1
+        obj.attr_string = 'changed'
+        obj.save()
+        self.assertTrue(self.last_sql().startswith('REPLACE'))
+        other = self.reload_object(obj)
+        self.assertEqual((other.attr_uint, other.attr_string), (1, 'changed'))
+
+    def testUnchangedNotWritten(self):
+        obj = self.reload_object(self.obj)
+        queries = len(self.spx_queries.captured_queries)
+        obj.save()
+        self.assertEqual(len(self.spx_queries.captured_queries), queries)
+
+
+class ResultCacheTestCase(SphinxModelTestCaseBase):
+    """ Checks caching of search results until write to index."""
+
+    def setUp(self):
+        super(ResultCacheTestCase, self).setUp()
+        result_cache_stats.clear()
+
+    def get_queryset(self):
+        return self.model.objects.all().cache(ttl=60).filter(
+            attr_uint=self.defaults['attr_uint']).with_meta()
+
+    def testRepeatedQueryHitsCache(self):
+        qs = self.get_queryset()
+        self.assertEqual(len(qs), 1)
+        self.assertEqual(qs.meta.total_found, 1)
+        queries = len(self.spx_queries.captured_queries)
+
+        qs = self.get_queryset()
+        self.assertEqual(len(qs), 1)
+        self.assertObjectEqualsToDefaults(qs[0])
+        self.assertEqual(qs.meta.total_found, 1)
+        self.assertEqual(len(self.spx_queries.captured_queries), queries)
+        self.assertEqual(result_cache_stats.stats(),
+                         {'hits': 1, 'misses': 1})
+
+    def testWriteInvalidatesCache(self):
+        list(self.get_queryset())
+        other = self.model.objects.create(
+            **dict(self.defaults, id=self.newid()))
+        self.assertEqual(len(self.get_queryset()), 2)
+
+        other.delete()
+        self.assertEqual(len(self.get_queryset()), 1)
+        self.assertEqual(result_cache_stats.stats()['hits'], 0)
+
+
+class ConnectionParamsTestCase(SimpleTestCase):
+    """ Checks options of connection to searchd."""
+
+    def testMultiStatementsEnabled(self):
+        connection = connections[settings.SPHINX_DATABASE_NAME]
+        flags = CLIENT.MULTI_STATEMENTS | CLIENT.MULTI_RESULTS
+        client_flag = connection.get_connection_params()['client_flag']
+        self.assertEqual(client_flag & flags, flags)
+        # flags set by mysql backend are kept
+        self.assertTrue(client_flag & CLIENT.FOUND_ROWS)
+
+
+class MmapCacheTestCase(SimpleTestCase):
+    """ Checks cache backend in shared memory-mapped file."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.cache = self.get_cache()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def get_cache(self):
+        return MmapCache(self.path, {'OPTIONS': {
+            'SIZE': 64 * 1024, 'SLOT_SIZE': 1024, 'WAYS': 4}})
+
+    def testResultSetsRoundTrip(self):
+        results = [[(1, 2 ** 40, 1.5, u'text', b'bytes', None)],
+                   [(u'total', u'1')]]
+        self.cache.set('key', results)
+        self.assertEqual(self.cache.get('key'), results)
+        self.assertIsNone(self.cache.get('missing'))
+
+        # another process opens same file
+        self.assertEqual(self.get_cache().get('key'), results)
+
+        # values not supported by row encoding are pickled
+        self.cache.set('key', {'now': datetime(2017, 1, 1)})
+        self.assertEqual(self.get_cache().get('key'),
+                         {'now': datetime(2017, 1, 1)})
+
+    def testAddIncrDelete(self):
+        self.assertTrue(self.cache.add('counter', 1, None))
+        self.assertFalse(self.cache.add('counter', 10, None))
+        self.assertEqual(self.cache.incr('counter'), 2)
+        self.assertEqual(self.get_cache().incr('counter', 3), 5)
+        self.cache.delete('counter')
+        self.assertRaises(ValueError, self.cache.incr, 'counter')
+
+    def testLargeValueNotCached(self):
+        self.cache.set('key', 'small')
+        self.cache.set('key', 'x' * 2048)
+        self.assertIsNone(self.cache.get('key'))
+
+    def testEviction(self):
+        capacity = self.cache.sets * self.cache.ways
+        for i in range(capacity * 2):
+            self.cache.set('key%d' % i, i)
+        cached = [i for i in range(capacity * 2)
+                  if self.cache.get('key%d' % i) is not None]
+        self.assertLessEqual(len(cached), capacity)
+        self.assertIn(capacity * 2 - 1, cached)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('key%d' % cached[0]))
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    """ Checks coalescing of concurrent calls with same key."""
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+        self.results = []
+
+    def slow_call(self, result):
+        def call():
+            time.sleep(0.2)
+            self.calls.append(result)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return call
+
+    def run_threads(self, key, func, count=5, timeout=5):
+        def target():
+            try:
+                self.results.append(self.flights.do(key, func, timeout))
+            except ValueError as e:
+                self.results.append(e)
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def testConcurrentCallsShareResult(self):
+        self.run_threads(('index', 1), self.slow_call([1, 2]))
+        self.assertEqual(self.calls, [[1, 2]])
+        self.assertEqual(self.results, [[1, 2]] * 5)
+        self.assertEqual(self.flights.stats(),
+                         {'executed': 1, 'shared': 4, 'timeouts': 0})
+
+    def testErrorRaisedInWaiters(self):
+        error = ValueError("searchd is down")
+        self.run_threads(('index', 1), self.slow_call(error))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, [error] * 5)
+
+    def testWaitersTimeout(self):
+        self.run_threads(('index', 1), self.slow_call(1), count=3,
+                         timeout=0.01)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.flights.stats()['timeouts'], 2)
+
+
+@override_settings(SPHINX_SINGLEFLIGHT_TIMEOUT=5)
+class SingleFlightQueryTestCase(SphinxModelTestCaseBase):
+    """ Checks sharing of concurrent search results."""
+
+    def setUp(self):
+        super(SingleFlightQueryTestCase, self).setUp()
+        flights.clear()
+
+    def testSharedResults(self):
+        results = []
+
+        def search():
+            results.append(list(self.model.objects.filter(
+                attr_uint=self.defaults['attr_uint'])))
+
+        threads = [threading.Thread(target=search) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 5)
+        for qs in results:
+            self.assertEqual(len(qs), 1)
+            self.assertObjectEqualsToDefaults(qs[0])
+        stats = flights.stats()
+        self.assertEqual(stats['executed'] + stats['shared'], 5)
+
+    def testWriteVisibleInSameThread(self):
+        self.assertEqual(len(self.model.objects.filter(attr_bool=True)), 1)
+        self.model.objects.create(**dict(self.defaults, id=self.newid()))
+        self.assertEqual(len(self.model.objects.filter(attr_bool=True)), 2)
+
+
+class RefreshAheadTestCase(SphinxModelTestCaseBase):
+    """ Checks refreshing of hot cached queries before expiration."""
+
+    def setUp(self):
+        super(RefreshAheadTestCase, self).setUp()
+        result_cache_stats.clear()
+        # background thread is idle, refreshes are made by test
+        self.refresher = enable_refresh_ahead(top=1, ahead=5, interval=3600)
+
+    def tearDown(self):
+        disable_refresh_ahead()
+        super(RefreshAheadTestCase, self).tearDown()
+
+    def search(self, attr_uint):
+        return list(self.model.objects.all().cache(ttl=60).filter(
+            attr_uint=attr_uint))
+
+    def testHotQueryRefreshed(self):
+        for _ in range(3):
+            self.search(self.defaults['attr_uint'])
+        self.search(0)
+        self.assertEqual(self.refresher.stats()['tracked'], 2)
+
+        # only top query is refreshed
+        query, = self.refresher.get_due(time.time() + 58)
+        self.assertEqual(query.hits, 1)
+        expires = query.expires
+        self.assertTrue(self.refresher.refresh(query))
+        self.assertGreater(query.expires, expires)
+        # another process doesn't refresh same results
+        self.assertFalse(self.refresher.refresh(query))
+
+        queries = len(self.spx_queries.captured_queries)
+        qs = self.search(self.defaults['attr_uint'])
+        self.assertObjectEqualsToDefaults(qs[0])
+        self.assertEqual(len(self.spx_queries.captured_queries), queries)
+
+    def testExpiringLaterNotRefreshed(self):
+        self.search(self.defaults['attr_uint'])
+        self.assertEqual(self.refresher.get_due(), [])
+
+
+class ContentHashTestCase(SphinxModelTestCaseBase):
+    """ Checks skipping writes of unchanged documents."""
+    model = models.ContentHashModel
+
+    def setUp(self):
+        super(ContentHashTestCase, self).setUp()
+        content_hash_stats.clear()
+
+    def load_with_text(self, **text):
+        """ Loads document, setting its full-text fields."""
+        obj = self.reload_object(self.obj)
+        obj.sphinx_field = text.get('sphinx_field',
+                                    self.defaults['sphinx_field'])
+        obj.other_field = text.get('other_field', '')
+        return obj
+
+    def testUnchangedSaveSkipped(self):
+        obj = self.load_with_text()
+        self.assertEqual(obj.attr_bigint, obj.get_content_hash())
+        queries = len(self.spx_queries.captured_queries)
+        obj.save()
+        self.assertEqual(len(self.spx_queries.captured_queries), queries)
+
+        obj.attr_uint = 1
+        obj.save()
+        self.assertEqual(self.reload_object(obj).attr_uint, 1)
+        self.assertEqual(content_hash_stats.stats(),
+                         {'written': 1, 'skipped': 1})
+
+    def testTextChangeWritten(self):
+        obj = self.load_with_text(sphinx_field='edited')
+        obj.save()
+        self.assertEqual(self.model.objects.match('edited').count(), 1)
+
+        self.model.objects.filter(pk=obj.pk).update(
+            sphinx_field='updated', other_field='', attr_string='updated')
+        self.assertEqual(self.model.objects.match('updated').count(), 1)
+        self.assertEqual(content_hash_stats.stats(),
+                         {'written': 2, 'skipped': 0})
+
+    def testDeferredTextSaveWritten(self):
+        obj = self.model.objects.get(pk=self.obj.pk)
+        queries = len(self.spx_queries.captured_queries)
+        obj.save()
+        # nothing changed, deferred full-text fields are not fetched
+        self.assertEqual(len(self.spx_queries.captured_queries), queries)
+
+        obj.attr_uint = 1
+        obj.save()
+        other = self.model.objects.match('hello').get(pk=obj.pk)
+        self.assertEqual(other.attr_uint, 1)
+        self.assertEqual(other.attr_bigint, 0)
+
+    def testUpdateResetsHash(self):
+        self.model.objects.filter(pk=self.obj.pk).update(attr_uint=1)
+        self.assertEqual(self.reload_object(self.obj).attr_bigint, 0)
+
+        self.model.objects.bulk_replace([self.model(**self.defaults)])
+        self.assertEqual(self.reload_object(self.obj).attr_uint,
+                         self.defaults['attr_uint'])
+
+    def testBulkReplaceSkipsUnchanged(self):
+        obj = self.model(**self.defaults)
+        other = self.model(id=self.newid(), attr_uint=1)
+        self.model.objects.filter(attr_uint=1).bulk_replace([obj, other])
+        self.assertEqual(content_hash_stats.stats(),
+                         {'written': 1, 'skipped': 1})
+        self.assertEqual(self.model.objects.count(), 2)
+
+
 class EscapingTestCase(SphinxModelTestCaseBase):
     """ Checks escaping symbols"""
 